@@ -1,8 +1,10 @@
 import streamlit as st
 from streamlit_folium import st_folium
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
+from PIL import Image, ImageOps
 import pandas as pd
+import numpy as np
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import hashlib
@@ -12,6 +14,28 @@ import os
 import warnings
 import math
 import random
+import sqlite3
+import threading
+import functools
+import html
+import queue
+import concurrent.futures
+import json
+import contextlib
+import io
+import bisect
+import re
+import collections
+if int(pd.__version__.split(".")[0]) < 3: pd.set_option("mode.copy_on_write", True) # pandas 3부터는 기본값
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError: # 스냅샷은 pyarrow가 있을 때만 사용
+    pa = feather = None
+try:
+    import redis
+except ImportError: # 여러 서버가 캐시를 공유할 때만 필요
+    redis = None
 
 # [설정] 경고 무시
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -109,13 +133,195 @@ def apply_css(is_dark):
         </style>
     """, unsafe_allow_html=True)
 
-IMG_DIR = "images"
+IMG_DIR = os.path.join("static", "images") # server.enableStaticServing 이면 app/static/images/... 로 바로 제공
 if not os.path.exists(IMG_DIR): os.makedirs(IMG_DIR)
 
 # === 데이터 구조 ===
-COLS_RESOURCES = ["id", "writer_id", "date", "company", "contact", "region", "complex", "role", "category", "item", "lat", "lon", "desc", "process", "verified", "image_path"]
-COLS_USERS = ["user_id", "password_hash", "company_name", "contact", "biz_no", "is_verified", "deal_count", "reputation", "join_date"]
-COLS_MESSAGES = ["req_id", "from_user", "to_user", "item_id", "status", "timestamp"]
+COLS_RESOURCES = ["id", "writer_id", "date", "company", "contact", "region", "complex", "role", "category", "item", "lat", "lon", "desc", "process", "verified", "image_path", "updated_at"]
+COLS_USERS = ["user_id", "password_hash", "company_name", "contact", "biz_no", "is_verified", "deal_count", "reputation", "join_date", "updated_at"]
+COLS_MESSAGES = ["req_id", "from_user", "to_user", "item_id", "status", "timestamp", "updated_at"]
+SHEET_COLS = {"resources": COLS_RESOURCES, "users": COLS_USERS, "messages": COLS_MESSAGES}
+SHEET_KEYS = {"resources": "id", "users": "user_id", "messages": "req_id"}
+SHEET_INDEXES = {"resources": ["writer_id", "updated_at"], "users": ["updated_at"], "messages": ["to_user", "from_user", "item_id", "updated_at"]}
+META_SHEET = "_meta" # 시트별 변경 마커: [sheet, rev(마지막 쓰기 ms), epoch(마지막 삭제/덮어쓰기 ms)]
+SYNC_SKEW_MS = 5000 # 서버 간 시계 오차만큼 겹쳐서 다시 받음 (키 기준 병합이라 중복 무해)
+RECONCILE_SEC = 300 # delta 동기화만 이어가다 놓친 변경이 있어도 이 간격마다 전체 로드로 바로잡음
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def _new_key():
+    # 새 행 키: 밀리초 + 임의 6자리 (같은 순간의 다른 세션과도 겹치지 않고, 숫자 순서는 시간순)
+    return f"{_now_ms()}{random.SystemRandom().randrange(10 ** 6):06d}"
+
+def _new_keys(count):
+    # 여러 행을 한 번에 만들 때: 같은 밀리초에 서로 다른 임의 6자리 (한 묶음 안에서도 겹치지 않음)
+    ms = _now_ms()
+    return [f"{ms}{r:06d}" for r in random.SystemRandom().sample(range(10 ** 6), count)]
+
+# === 스키마 (컬럼 타입은 로드할 때 한 번만 적용, 선언이 없는 컬럼은 문자열) ===
+# 캐시된 프레임은 공유되는 읽기 전용 값: 바꿀 때는 항상 새 프레임을 만듦 (copy-on-write)
+SCHEMA = {
+    "resources": {"lat": "float32", "lon": "float32", "region": "category", "role": "category", "category": "category", "verified": "bool", "date": "date", "updated_at": "int"},
+    "users": {"is_verified": "bool", "deal_count": "int", "reputation": "float", "join_date": "date", "updated_at": "int"},
+    "messages": {"status": "category", "timestamp": "datetime", "updated_at": "int"},
+}
+SCHEMA_VERSION = 2 # 스키마가 바뀌면 올려서 예전 스냅샷을 버림
+DATE_FORMATS = {"date": "%Y-%m-%d", "datetime": "%Y-%m-%d %H:%M"}
+
+def _keyed(sheet_name, df):
+    # 키 컬럼 값을 인덱스로 (키 조회는 해시 조회, 병합은 인덱스 정렬)
+    key = SHEET_KEYS.get(sheet_name)
+    if key in df.columns: df.index = pd.Index(df[key].to_numpy())
+    return df
+
+def _typed(sheet_name, df):
+    # 시트 문자열(또는 화면에서 넘어온 원시값) -> 선언된 dtype
+    kinds = SCHEMA.get(sheet_name, {})
+    cols = {}
+    for col in df.columns:
+        values, kind = df[col], kinds.get(col, "str")
+        if kind == "float32": values = pd.to_numeric(values, errors="coerce").astype("float32")
+        elif kind == "float": values = pd.to_numeric(values, errors="coerce").astype("float64") # 화면에 그대로 보이는 값 (float32면 2.3 -> 2.299999952316284)
+        elif kind == "int": values = pd.to_numeric(values, errors="coerce").fillna(0).astype("int64")
+        elif kind == "bool": values = values if values.dtype == bool else values.astype(str).str.upper().eq("TRUE")
+        elif kind == "category": values = values.fillna("").astype(str).astype("category")
+        elif kind in DATE_FORMATS: values = pd.to_datetime(values, errors="coerce", format="ISO8601")
+        else: values = values.fillna("").astype(str)
+        cols[col] = values
+    return _keyed(sheet_name, pd.DataFrame(cols, index=df.index))
+
+def _cell(sheet_name, col, value):
+    # 값 하나 -> 시트에 쓰는 문자열 (TRUE/FALSE, 선언된 날짜 형식, 빈 값)
+    if value is None or (pd.api.types.is_scalar(value) and not isinstance(value, str) and pd.isna(value)): return ""
+    if isinstance(value, (bool, np.bool_)): return "TRUE" if value else "FALSE"
+    kind = SCHEMA.get(sheet_name, {}).get(col)
+    if kind in DATE_FORMATS and isinstance(value, datetime): return value.strftime(DATE_FORMATS[kind])
+    return str(value)
+
+def _encoded(sheet_name, df):
+    # 타입 프레임 -> 시트 문자열 프레임 (_typed의 역)
+    kinds = SCHEMA.get(sheet_name, {})
+    cols = {}
+    for col in df.columns:
+        values, kind = df[col], kinds.get(col, "str")
+        if values.dtype == bool: values = values.map({True: "TRUE", False: "FALSE"})
+        elif kind in DATE_FORMATS and pd.api.types.is_datetime64_any_dtype(values): values = values.dt.strftime(DATE_FORMATS[kind]).fillna("")
+        elif values.dtype == object: values = values.map(lambda v: _cell(sheet_name, col, v))
+        else: values = values.astype(str).fillna("")
+        cols[col] = values
+    return pd.DataFrame(cols).reset_index(drop=True)
+
+def _aligned(a, b):
+    # 두 프레임의 범주형 컬럼 카테고리를 합쳐서 맞춤 (concat/대입 뒤에도 category 유지)
+    for col in a.columns.intersection(b.columns):
+        if isinstance(a[col].dtype, pd.CategoricalDtype) and isinstance(b[col].dtype, pd.CategoricalDtype):
+            cats = a[col].cat.categories.union(b[col].cat.categories)
+            if not cats.equals(a[col].cat.categories): a[col] = a[col].cat.set_categories(cats)
+            if not cats.equals(b[col].cat.categories): b[col] = b[col].cat.set_categories(cats)
+    return a, b
+
+# === [계측] 프로세스 단위 성능 지표 ===
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # 지연 히스토그램 구간 (초)
+METRIC_PREFIX = "factory_link"
+
+class Metrics:
+    # 이름+라벨별 지연 히스토그램과 카운터. 모든 세션과 백그라운드 스레드가 같은 인스턴스에 누적
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.hists = {}    # (이름, 라벨) -> [구간별 건수(+초과 1칸), 합계, 최댓값]
+            self.counters = {} # (이름, 라벨) -> 값
+            self.since = time.time()
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, sec, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(METRIC_BUCKETS, sec)
+        with self.lock:
+            h = self.hists.setdefault(key, [[0] * (len(METRIC_BUCKETS) + 1), 0.0, 0.0])
+            h[0][i] += 1; h[1] += sec; h[2] = max(h[2], sec)
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _quantile(buckets, total, peak, q):
+        # 구간 상한으로 근사 (넘친 구간은 최댓값)
+        seen = 0
+        for bound, n in zip(METRIC_BUCKETS + (peak,), buckets):
+            seen += n
+            if seen >= q * total: return min(bound, peak)
+        return peak
+
+    def total(self, name, **match):
+        # 라벨이 match와 맞는 카운터 합계
+        with self.lock: return sum(v for (n, labels), v in self.counters.items() if n == name and match.items() <= dict(labels).items())
+
+    def timings(self):
+        with self.lock: hists = {k: (list(v[0]), v[1], v[2]) for k, v in self.hists.items()}
+        rows = []
+        for (name, labels), (buckets, total_sec, peak) in sorted(hists.items()):
+            n = sum(buckets)
+            rows.append({"지표": name, "라벨": ", ".join(f"{k}={v}" for k, v in labels), "건수": n, "합계(s)": round(total_sec, 3),
+                         "평균(ms)": round(total_sec / n * 1000, 1), "p50(ms)": round(self._quantile(buckets, n, peak, 0.5) * 1000, 1),
+                         "p95(ms)": round(self._quantile(buckets, n, peak, 0.95) * 1000, 1), "최대(ms)": round(peak * 1000, 1)})
+        return pd.DataFrame(rows)
+
+    def counts(self):
+        with self.lock: counters = dict(self.counters)
+        return pd.DataFrame([{"지표": name, "라벨": ", ".join(f"{k}={v}" for k, v in labels), "값": v} for (name, labels), v in sorted(counters.items())])
+
+    def prometheus(self):
+        # Prometheus 텍스트 형식: 히스토그램은 <이름>_seconds, 카운터는 <이름>_total
+        def fmt(labels, **extra):
+            pairs = list(labels) + list(extra.items())
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs) + "}" if pairs else ""
+        with self.lock: hists, counters = {k: (list(v[0]), v[1]) for k, v in self.hists.items()}, dict(self.counters)
+        lines, typed = [], set()
+        for (name, labels), (buckets, total_sec) in sorted(hists.items()):
+            metric = f"{METRIC_PREFIX}_{name}_seconds"
+            if metric not in typed: lines.append(f"# TYPE {metric} histogram"); typed.add(metric)
+            seen = 0
+            for bound, n in zip(METRIC_BUCKETS, buckets):
+                seen += n
+                lines.append(f"{metric}_bucket{fmt(labels, le=bound)} {seen}")
+            lines.append(f'{metric}_bucket{fmt(labels, le="+Inf")} {sum(buckets)}')
+            lines.append(f"{metric}_sum{fmt(labels)} {total_sec:.6f}")
+            lines.append(f"{metric}_count{fmt(labels)} {sum(buckets)}")
+        for (name, labels), v in sorted(counters.items()):
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            if metric not in typed: lines.append(f"# TYPE {metric} counter"); typed.add(metric)
+            lines.append(f"{metric}{fmt(labels)} {v}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps({"since": self.since, "at": time.time(), "buckets": list(METRIC_BUCKETS),
+                               "histograms": [{"name": n, "labels": dict(l), "counts": v[0], "sum": v[1], "max": v[2]} for (n, l), v in self.hists.items()],
+                               "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self.counters.items()]}, ensure_ascii=False)
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+def _timed(name):
+    # 첫 인자(시트 이름)를 라벨로 실행 시간 기록
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(sheet_name, *args, **kwargs):
+            with get_metrics().timed(name, sheet=sheet_name): return fn(sheet_name, *args, **kwargs)
+        return inner
+    return wrap
 
 # === 구글 연결 ===
 @st.cache_resource
@@ -129,55 +335,1452 @@ def connect_google_sheet():
     client = gspread.authorize(creds)
     return client.open("Factory_DB") 
 
-# === [안정화] 데이터 로드 (재시도 + 캐시) ===
-@st.cache_data(ttl=30, show_spinner=False)
+# === 저장소 엔진 ===
+# 공통 인터페이스: load / load_many / load_since / marker / touch / find / append / update / delete / rewrite
+def _decode(sheet_name, header, rows):
+    # 값 행렬(문자열) -> 스키마 타입 프레임. 모자란 컬럼은 빈 값으로 채움
+    cols = list(dict.fromkeys(list(header) + SHEET_COLS.get(sheet_name, [])))
+    width = len(header)
+    df = pd.DataFrame([(r + [""] * width)[:width] for r in rows], columns=header, dtype=object) if header else pd.DataFrame()
+    return _typed(sheet_name, df.reindex(columns=cols, fill_value=""))
+
+def _missing_sheet(error):
+    # 시트가 정말 없는 경우만 True (429/5xx 같은 일시 오류는 False -> 호출한 쪽이 재시도)
+    if isinstance(error, gspread.exceptions.WorksheetNotFound): return True
+    return isinstance(error, gspread.exceptions.APIError) and error.response.status_code == 400 and "Unable to parse range" in str(error)
+
+class SheetsStore:
+    # 구글 시트 엔진 (gspread). find는 캐시된 전체 프레임을 필터링
+    indexed = False
+
+    def __init__(self, connect):
+        self.connect = connect # 인증은 첫 API 호출 때 (디스크 스냅샷으로 뜰 때는 백그라운드 갱신 스레드에서)
+        self.connect_lock = threading.Lock()
+        self._sh = None
+        self.headers = {}
+        self.worksheets = {} # 워크시트 핸들 캐시 (sh.worksheet()도 메타데이터 API 호출 1회)
+        self.markers = (0.0, None) # (조회 시각, {시트: 마커} 또는 _meta 없음=None) - 한 번의 호출을 여러 시트가 공유
+
+    @property
+    def sh(self):
+        if self._sh is None:
+            with self.connect_lock:
+                if self._sh is None: self._sh = self.connect()
+        return self._sh
+
+    def _worksheet(self, sheet_name):
+        if sheet_name not in self.worksheets: self.worksheets[sheet_name] = self.sh.worksheet(sheet_name)
+        return self.worksheets[sheet_name]
+
+    def _parse_markers(self, rows):
+        return {r[0]: {"rev": float(r[1] or 0), "epoch": float(r[2] or 0)} for r in rows if len(r) >= 3}
+
+    def load(self, sheet_name):
+        return self.load_many([sheet_name])[sheet_name][0]
+
+    def load_many(self, sheet_names):
+        # 여러 시트 + _meta 마커를 values batch-get 한 번에 받아 {시트: (df, 마커)}로 디코딩
+        ranges = [f"'{name}'" for name in sheet_names]
+        meta = f"'{META_SHEET}'!A2:C{len(SHEET_COLS) + 1}"
+        try:
+            got = self.sh.values_batch_get(ranges + [meta]).get("valueRanges", [])
+            markers = self._parse_markers(got.pop().get("values", []))
+        except gspread.exceptions.APIError as e: # _meta 시트가 아직 없을 때만 마커 없이 다시 받음 (429/5xx는 그대로 올림)
+            if not _missing_sheet(e): raise
+            got = self.sh.values_batch_get(ranges).get("valueRanges", [])
+            markers = None
+        self.markers = (time.time(), markers)
+        out = {}
+        for name, vr in zip(sheet_names, got):
+            values = vr.get("values", [])
+            header = values[0] if values else []
+            self.headers[name] = header
+            marker = markers.get(name, {"rev": 0, "epoch": 0}) if markers is not None else None
+            out[name] = (_decode(name, header, values[1:]), marker)
+        return out
+
+    def marker(self, sheet_name):
+        # _meta 시트 한 범위만 읽어 변경 여부 판단 (없으면 None -> 전체 로드)
+        fetched_at, markers = self.markers
+        if time.time() - fetched_at > 2:
+            try:
+                rows = self.sh.values_get(f"'{META_SHEET}'!A2:C{len(SHEET_COLS) + 1}").get("values", [])
+                markers = self._parse_markers(rows)
+            except gspread.exceptions.APIError as e: # 429/5xx는 그대로 올려 백오프/차단기가 처리 (전체 로드로 넘어가지 않게)
+                if not _missing_sheet(e): raise
+                markers = None
+            self.markers = (time.time(), markers)
+        if markers is None: return None
+        return markers.get(sheet_name, {"rev": 0, "epoch": 0})
+
+    def touch(self, sheet_name, rev, destructive=False):
+        # 쓰기 후 마커 갱신 (삭제/덮어쓰기는 epoch도 바꿔서 다른 프로세스가 전체 로드하게 함)
+        # 저장된 행을 새로 읽어 rev는 앞으로만 움직이고, epoch는 바꿀 때만 씀 (캐시된 마커의 epoch를 되돌려 쓰지 않음)
+        row = list(SHEET_COLS).index(sheet_name) + 2
+        try:
+            stored = self._parse_markers(self.sh.values_get(f"'{META_SHEET}'!A{row}:C{row}").get("values", [])).get(sheet_name)
+        except gspread.exceptions.APIError as e:
+            if not _missing_sheet(e): raise
+            try: self.sh.add_worksheet(META_SHEET, rows=len(SHEET_COLS) + 1, cols=3)
+            except gspread.exceptions.APIError as e2: # 다른 프로세스가 먼저 만든 경우만 계속
+                if "already exists" not in str(e2): raise
+            self.sh.values_update(f"'{META_SHEET}'!A1:C1", params={"valueInputOption": "RAW"}, body={"values": [["sheet", "rev", "epoch"]]})
+            stored = None
+        marker = dict(stored or {"rev": 0, "epoch": 0})
+        marker["rev"] = int(max(marker["rev"] + 1, rev))
+        if destructive: marker["epoch"] = marker["rev"]
+        if stored is None or destructive:
+            self.sh.values_update(f"'{META_SHEET}'!A{row}:C{row}", params={"valueInputOption": "RAW"}, body={"values": [[sheet_name, str(marker["rev"]), str(marker["epoch"])]]})
+        else:
+            self.sh.values_update(f"'{META_SHEET}'!B{row}", params={"valueInputOption": "RAW"}, body={"values": [[str(marker["rev"])]]})
+        fetched_at, markers = self.markers
+        self.markers = (fetched_at, dict(markers or {}, **{sheet_name: marker}))
+
+    def load_since(self, sheet_name, rev):
+        # updated_at 한 컬럼만 읽고, 바뀐 행만 범위 묶음으로 가져옴 (호출 2회)
+        header = self.headers.get(sheet_name)
+        if header is None: # 스냅샷으로 시작한 프로세스는 헤더를 아직 모름
+            header = self.headers[sheet_name] = (self.sh.values_get(f"'{sheet_name}'!1:1").get("values") or [[]])[0]
+        if not header or "updated_at" not in header: return None
+        col = gspread.utils.rowcol_to_a1(1, header.index("updated_at") + 1)[:-1]
+        stamps = self.sh.values_get(f"'{sheet_name}'!{col}2:{col}").get("values", [])
+        rows = [i + 2 for i, v in enumerate(stamps) if v and str(v[0]).replace(".", "", 1).isdigit() and float(v[0]) > rev - SYNC_SKEW_MS]
+        if not rows: return _decode(sheet_name, header, [])
+        if len(rows) > len(stamps) // 2: return None # 절반 이상 바뀌었으면 전체 로드가 낫다
+        last = gspread.utils.rowcol_to_a1(1, len(header))[:-1]
+        got = self.sh.values_batch_get([f"'{sheet_name}'!A{r}:{last}{r}" for r in rows]).get("valueRanges", [])
+        return _decode(sheet_name, header, [(vr.get("values") or [[]])[0] for vr in got])
+
+    def _header(self, worksheet, sheet_name, extra_cols=()):
+        # 헤더 행만 읽고, 비어 있거나 컬럼이 모자라면 헤더만 보강
+        header = worksheet.row_values(1)
+        missing = [c for c in dict.fromkeys(list(SHEET_COLS.get(sheet_name, [])) + list(extra_cols)) if c not in header]
+        if missing:
+            header = header + missing
+            worksheet.update([header], "A1")
+        self.headers[sheet_name] = header
+        return header
+
+    def _key_rows(self, worksheet, sheet_name, header):
+        # 키 컬럼 한 줄만 읽어서 {키: 시트 행 번호} 매핑 (헤더가 1행)
+        col = header.index(SHEET_KEYS[sheet_name]) + 1
+        return {str(v): i + 2 for i, v in enumerate(worksheet.col_values(col)[1:])}
+
+    def append(self, sheet_name, rows):
+        # 신규 행 추가: append 호출 1회
+        worksheet = self._worksheet(sheet_name)
+        header = self._header(worksheet, sheet_name, [c for r in rows for c in r])
+        worksheet.append_rows([[_cell(sheet_name, c, r.get(c, "")) for c in header] for r in rows])
+
+    def update(self, sheet_name, changes):
+        # 셀 단위 수정: changes = {키: {컬럼: 값}} -> batch_update 호출 1회
+        worksheet = self._worksheet(sheet_name)
+        header = self._header(worksheet, sheet_name, [c for v in changes.values() for c in v])
+        rows = self._key_rows(worksheet, sheet_name, header)
+        batch = []
+        for key, cols in changes.items():
+            if str(key) not in rows: continue
+            for col, val in cols.items():
+                a1 = gspread.utils.rowcol_to_a1(rows[str(key)], header.index(col) + 1)
+                batch.append({"range": a1, "values": [[_cell(sheet_name, col, val)]]})
+        if batch: worksheet.batch_update(batch)
+
+    def delete(self, sheet_name, keys):
+        # 행 삭제: 연속 구간으로 묶어 아래쪽부터 deleteDimension (batch_update 호출 1회)
+        worksheet = self._worksheet(sheet_name)
+        rows = self._key_rows(worksheet, sheet_name, worksheet.row_values(1))
+        targets = sorted({rows[str(k)] for k in keys if str(k) in rows}, reverse=True)
+        spans = []
+        for r in targets:
+            if spans and spans[-1][0] == r + 1: spans[-1][0] = r
+            else: spans.append([r, r])
+        reqs = [{"deleteDimension": {"range": {"sheetId": worksheet.id, "dimension": "ROWS", "startIndex": a - 1, "endIndex": b}}} for a, b in spans]
+        if reqs: self.sh.batch_update({"requests": reqs})
+
+    def rewrite(self, sheet_name, df):
+        worksheet = self._worksheet(sheet_name)
+        worksheet.clear()
+        worksheet.update([df.columns.values.tolist()] + _encoded(sheet_name, df).values.tolist())
+        self.headers[sheet_name] = df.columns.values.tolist()
+
+class SQLiteStore:
+    # 로컬 SQLite 엔진: 키 컬럼 PRIMARY KEY + 조회 컬럼 인덱스, 구글 의존성 없음
+    indexed = True
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{META_SHEET}" ("sheet" TEXT PRIMARY KEY, "rev" REAL, "epoch" REAL)')
+            for sheet_name, cols in SHEET_COLS.items():
+                defs = ", ".join(f'"{c}" TEXT PRIMARY KEY' if c == SHEET_KEYS[sheet_name] else f'"{c}" TEXT' for c in cols)
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{sheet_name}" ({defs})')
+                have = {r[1] for r in self.conn.execute(f'PRAGMA table_info("{sheet_name}")')}
+                for col in cols:
+                    if col not in have: self.conn.execute(f'ALTER TABLE "{sheet_name}" ADD COLUMN "{col}" TEXT')
+                for col in SHEET_INDEXES.get(sheet_name, []):
+                    self.conn.execute(f'CREATE INDEX IF NOT EXISTS "ix_{sheet_name}_{col}" ON "{sheet_name}" ("{col}")')
+
+    def _select(self, sheet_name, where=None):
+        where = where or {}
+        sql = f'SELECT * FROM "{sheet_name}"'
+        if where: sql += " WHERE " + " AND ".join(f'"{c}" = ?' for c in where)
+        with self.lock:
+            df = pd.read_sql_query(sql, self.conn, params=[str(v) for v in where.values()])
+        return _typed(sheet_name, df)
+
+    def load(self, sheet_name):
+        return self._select(sheet_name)
+
+    def load_many(self, sheet_names):
+        return {name: (self.load(name), self.marker(name)) for name in sheet_names}
+
+    def marker(self, sheet_name):
+        with self.lock:
+            row = self.conn.execute(f'SELECT "rev", "epoch" FROM "{META_SHEET}" WHERE "sheet" = ?', (sheet_name,)).fetchone()
+        return {"rev": row[0], "epoch": row[1]} if row else {"rev": 0, "epoch": 0}
+
+    def touch(self, sheet_name, rev, destructive=False):
+        with self.lock, self.conn:
+            self.conn.execute(f'INSERT OR IGNORE INTO "{META_SHEET}" VALUES (?, 0, 0)', (sheet_name,))
+            # SET 안의 "rev"는 갱신 전 값: rev는 앞으로만, epoch는 삭제/덮어쓰기일 때 새 rev로
+            self.conn.execute(f'UPDATE "{META_SHEET}" SET "rev" = MAX("rev" + 1, ?)' + (', "epoch" = MAX("rev" + 1, ?)' if destructive else '') + ' WHERE "sheet" = ?', (rev, rev, sheet_name) if destructive else (rev, sheet_name))
+
+    def load_since(self, sheet_name, rev):
+        with self.lock:
+            df = pd.read_sql_query(f'SELECT * FROM "{sheet_name}" WHERE CAST("updated_at" AS REAL) > ?', self.conn, params=[rev - SYNC_SKEW_MS])
+        return _typed(sheet_name, df)
+
+    def find(self, sheet_name, **where):
+        return self._select(sheet_name, where)
+
+    def _insert(self, sheet_name, rows):
+        cols = SHEET_COLS[sheet_name]
+        names = ", ".join(f'"{c}"' for c in cols)
+        marks = ", ".join("?" * len(cols))
+        self.conn.executemany(f'INSERT INTO "{sheet_name}" ({names}) VALUES ({marks})',[[_cell(sheet_name, c, r.get(c, "")) for c in cols] for r in rows])
+
+    def append(self, sheet_name, rows):
+        with self.lock, self.conn:
+            self._insert(sheet_name, rows)
+
+    def update(self, sheet_name, changes):
+        key = SHEET_KEYS[sheet_name]
+        with self.lock, self.conn:
+            for k, cols in changes.items():
+                cols = {c: v for c, v in cols.items() if c in SHEET_COLS[sheet_name]}
+                if not cols: continue
+                sets = ", ".join(f'"{c}" = ?' for c in cols)
+                self.conn.execute(f'UPDATE "{sheet_name}" SET {sets} WHERE "{key}" = ?', [_cell(sheet_name, c, v) for c, v in cols.items()] + [str(k)])
+
+    def delete(self, sheet_name, keys):
+        key = SHEET_KEYS[sheet_name]
+        with self.lock, self.conn:
+            self.conn.executemany(f'DELETE FROM "{sheet_name}" WHERE "{key}" = ?', [(str(k),) for k in keys])
+
+    def rewrite(self, sheet_name, df):
+        with self.lock, self.conn:
+            self.conn.execute(f'DELETE FROM "{sheet_name}"')
+            self._insert(sheet_name, _encoded(sheet_name, df).to_dict("records"))
+
+def _storage_config():
+    # 환경변수 > secrets [storage] > 기본값(구글 시트)
+    try: conf = dict(st.secrets.get("storage", {}))
+    except Exception: conf = {}
+    engine = os.environ.get("FACTORY_LINK_STORAGE", conf.get("engine", "gsheets"))
+    path = os.environ.get("FACTORY_LINK_DB", conf.get("path", "factory_link.db"))
+    snapshot_dir = os.environ.get("FACTORY_LINK_SNAPSHOTS", conf.get("snapshot_dir", "snapshots"))
+    shared = os.environ.get("FACTORY_LINK_SHARED", conf.get("shared", "")) # 예: redis://localhost:6379/0
+    return engine, path, snapshot_dir, shared
+
+class InstrumentedStore:
+    # 저장소 호출마다 건수/지연/오류/행 수를 기록 (write-behind·백그라운드 갱신 스레드의 호출 포함)
+    OPS = ("load", "load_many", "load_since", "marker", "touch", "find", "append", "update", "delete", "rewrite")
+
+    def __init__(self, store, metrics, engine):
+        self.store, self.metrics, self.engine = store, metrics, engine
+
+    @staticmethod
+    def _rows(op, args, result):
+        if op in ("append", "update", "delete", "rewrite"): return len(args[1])
+        if op == "load_many": return sum(len(df) for df, _ in result.values())
+        if op in ("load", "load_since", "find") and result is not None: return len(result)
+        return 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if name not in self.OPS: return attr
+        def call(*args, **kwargs):
+            self.metrics.inc("store_calls", engine=self.engine, op=name)
+            try:
+                with self.metrics.timed("store_call", engine=self.engine, op=name): result = attr(*args, **kwargs)
+            except Exception:
+                self.metrics.inc("store_errors", engine=self.engine, op=name); raise
+            rows = self._rows(name, args, result)
+            if rows: self.metrics.inc("store_rows", rows, engine=self.engine, op=name)
+            return result
+        return call
+
+class InstrumentedSheet:
+    # gspread 스프레드시트/워크시트 프록시: 실제 HTTP 요청을 보내는 메서드 호출마다 api_calls 기록 (요청 한도와 같은 단위)
+    # 저장소 메서드 하나가 요청 여러 개가 되므로(update = 헤더 + 키 열 + batch_update) store_calls와 따로 셈
+    REQUESTS = {"values_get", "values_batch_get", "values_update", "values_append", "values_clear", "batch_update", "fetch_sheet_metadata",
+                "worksheet", "worksheets", "add_worksheet", "row_values", "col_values", "get", "batch_get", "get_all_values", "get_all_records",
+                "update", "append_row", "append_rows", "clear", "delete_rows"}
+    HANDLES = {"worksheet", "add_worksheet"} # 돌려받은 워크시트 핸들도 감쌈
+
+    def __init__(self, target, metrics):
+        self.target, self.metrics = target, metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self.target, name)
+        if name not in self.REQUESTS or not callable(attr): return attr
+        def call(*args, **kwargs):
+            self.metrics.inc("api_calls", method=name)
+            try: result = attr(*args, **kwargs)
+            except Exception as e:
+                self.metrics.inc("api_errors", method=name, status=getattr(getattr(e, "response", None), "status_code", "error")); raise
+            if name in self.HANDLES: return InstrumentedSheet(result, self.metrics)
+            if name == "worksheets": return [InstrumentedSheet(w, self.metrics) for w in result]
+            return result
+        return call
+
+@st.cache_resource
+def get_store():
+    engine, path, _, _ = _storage_config()
+    metrics = get_metrics()
+    if engine == "sqlite": return InstrumentedStore(SQLiteStore(path), metrics, engine)
+    def connect():
+        with metrics.timed("connect"): sh = connect_google_sheet()
+        return InstrumentedSheet(sh, metrics)
+    return InstrumentedStore(SheetsStore(connect), metrics, engine)
+
+# === 디스크 스냅샷 / 프로세스 간 공유 캐시 ===
+# 공통 인터페이스: save / load / info / mark_checked / generation / bump / lock
+# generation은 시트별 공유 세대 카운터(쓰기·무효화마다 +1), 스냅샷에는 어느 세대의 내용인지 함께 기록
+SHARED_POLL_SEC = 0.5 # 공유 세대를 다시 읽는 간격
+SHARED_LOCK_SEC = 30 # 한 프로세스가 원본을 받는 동안 다른 프로세스가 기다리는 최대 시간
+
+def _snapshot_table(df, meta):
+    # 스키마 타입(float, category, bool, datetime) 그대로 저장. 남은 object 컬럼만 문자열로
+    df = df.reset_index(drop=True)
+    df = df.astype({c: str for c in df.columns if df[c].dtype == object})
+    return pa.Table.from_pandas(df, preserve_index=False).replace_schema_metadata({"factory_link": json.dumps(dict(meta, schema=SCHEMA_VERSION))})
+
+def _snapshot_frame(sheet_name, table):
+    meta = json.loads(table.schema.metadata[b"factory_link"])
+    if meta.get("schema") != SCHEMA_VERSION: return None # 예전 스키마로 저장된 스냅샷
+    return _keyed(sheet_name, table.to_pandas()), meta
+
+class SnapshotStore:
+    # 같은 서버의 프로세스끼리 공유: <dir>/<시트>.feather(읽을 때 memory map) + <시트>.gen + <시트>.lock
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, sheet_name, ext="feather"):
+        return os.path.join(self.path, f"{sheet_name}.{ext}")
+
+    def _replace(self, sheet_name, ext, write):
+        # 임시 파일에 쓰고 원자적으로 교체: 읽는 쪽은 항상 완전한 파일만 봄
+        tmp = f"{self._file(sheet_name, ext)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        write(tmp)
+        os.replace(tmp, self._file(sheet_name, ext))
+
+    def save(self, sheet_name, df, marker, gen=0):
+        meta = {"marker": marker, "saved": time.time(), "gen": gen}
+        self._replace(sheet_name, "feather", lambda tmp: feather.write_feather(_snapshot_table(df, meta), tmp, compression="uncompressed")) # 압축하면 memory map 이점이 없음
+        return meta["saved"]
+
+    def load(self, sheet_name):
+        # -> (df, 메타) 또는 None
+        try: return _snapshot_frame(sheet_name, feather.read_table(self._file(sheet_name), memory_map=True))
+        except Exception: return None
+
+    def info(self, sheet_name):
+        # 데이터는 읽지 않고 메타만 (checked = 마지막으로 원본과 대조한 시각 = 파일 수정 시각)
+        try:
+            with pa.memory_map(self._file(sheet_name)) as source:
+                meta = json.loads(pa.ipc.open_file(source).schema.metadata[b"factory_link"])
+            return dict(meta, checked=os.path.getmtime(self._file(sheet_name)))
+        except Exception: return None
+
+    def mark_checked(self, sheet_name):
+        os.utime(self._file(sheet_name))
+
+    def generation(self, sheet_name):
+        try:
+            with open(self._file(sheet_name, "gen")) as f: return int(f.read() or 0)
+        except FileNotFoundError: return 0
+
+    def bump(self, sheet_name):
+        # lock()을 잡은 상태에서 호출
+        gen = self.generation(sheet_name) + 1
+        def write(tmp):
+            with open(tmp, "w") as f: f.write(str(gen))
+        self._replace(sheet_name, "gen", write)
+        return gen
+
+    def _abandoned(self, path, timeout):
+        # 너무 오래됐거나 (POSIX에서) 잡고 있던 프로세스가 이미 죽은 잠금
+        try:
+            if time.time() - os.path.getmtime(path) > timeout: return True
+            with open(path) as f: pid = int(f.read() or 0)
+        except (OSError, ValueError): return False
+        if os.name == "nt" or not pid or pid == os.getpid(): return False
+        try: os.kill(pid, 0)
+        except ProcessLookupError: return True
+        except OSError: pass
+        return False
+
+    @contextlib.contextmanager
+    def lock(self, sheet_name, timeout=SHARED_LOCK_SEC):
+        # 잠금 파일을 배타적으로 생성 (OS 무관). 못 잡으면 잠금 없이 진행 - 중복 조회가 생길 뿐
+        path = self._file(sheet_name, "lock")
+        deadline = time.time() + timeout
+        fd = None
+        while fd is None:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+            except FileExistsError:
+                if self._abandoned(path, timeout):
+                    try: os.remove(path)
+                    except OSError: pass
+                    continue
+                if time.time() > deadline: break
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fd is not None:
+                os.close(fd)
+                try: os.remove(path)
+                except OSError: pass
+
+class RedisSnapshotStore:
+    # 여러 서버/레플리카가 공유: Feather 바이트 + 메타(JSON) + 세대 카운터 + 분산 잠금을 Redis 한 곳에
+    def __init__(self, url, prefix="factory_link"):
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, sheet_name, part):
+        return f"{self.prefix}:{sheet_name}:{part}"
+
+    def save(self, sheet_name, df, marker, gen=0):
+        meta = {"marker": marker, "saved": time.time(), "gen": gen}
+        sink = pa.BufferOutputStream()
+        feather.write_feather(_snapshot_table(df, meta), sink)
+        self.client.mset({self._key(sheet_name, "data"): sink.getvalue().to_pybytes(), self._key(sheet_name, "info"): json.dumps(dict(meta, checked=meta["saved"]))})
+        return meta["saved"]
+
+    def load(self, sheet_name):
+        data = self.client.get(self._key(sheet_name, "data"))
+        return _snapshot_frame(sheet_name, feather.read_table(pa.BufferReader(data))) if data else None
+
+    def info(self, sheet_name):
+        raw = self.client.get(self._key(sheet_name, "info"))
+        return json.loads(raw) if raw else None
+
+    def mark_checked(self, sheet_name):
+        info = self.info(sheet_name)
+        if info: self.client.set(self._key(sheet_name, "info"), json.dumps(dict(info, checked=time.time())))
+
+    def generation(self, sheet_name):
+        return int(self.client.get(self._key(sheet_name, "gen")) or 0)
+
+    def bump(self, sheet_name):
+        return self.client.incr(self._key(sheet_name, "gen"))
+
+    @contextlib.contextmanager
+    def lock(self, sheet_name, timeout=SHARED_LOCK_SEC):
+        lock = self.client.lock(self._key(sheet_name, "lock"), timeout=timeout, blocking_timeout=timeout)
+        acquired = lock.acquire()
+        try:
+            yield
+        finally:
+            if acquired:
+                try: lock.release()
+                except redis.exceptions.LockError: pass # 만료되어 이미 풀림
+
+@st.cache_resource
+def get_snapshots():
+    # shared에 Redis 주소가 있으면 서버 간 공유, 아니면 구글 시트 엔진일 때 로컬 디스크(같은 서버의 프로세스끼리 공유)
+    engine, _, snapshot_dir, shared = _storage_config()
+    if feather is None: return None
+    if shared.startswith(("redis://", "rediss://", "unix://")) and redis is not None: return RedisSnapshotStore(shared)
+    if engine == "sqlite": return None # 로컬 DB는 이미 디스크에 있음
+    try: return SnapshotStore(snapshot_dir)
+    except OSError: return None
+
+# === 시트별 캐시 (세대 카운터 + write-through) ===
+class SheetCache:
+    # {시트: {gen, checked, df, version, marker}}. 쓰기는 해당 시트의 세대만 올리고 프레임을 교체(copy-on-write)
+    # TTL이 지나면 전체를 다시 받지 않고 변경 마커 -> 바뀐 행만 병합(delta sync)
+    # 만료된 스냅샷은 그대로 돌려주고 백그라운드 스레드가 갱신(stale-while-revalidate)
+    # snapshots가 있으면 원본에서 받은 프레임을 거기에도 남기고, 새 프로세스는 거기서 시작.
+    # 공유 세대가 바뀌면(다른 프로세스의 쓰기) 다시 읽고, TTL 안에 다른 프로세스가 받아 둔 것이 있으면 원본 대신 그것을 씀
+    def __init__(self, ttl=10, snapshots=None, metrics=None):
+        self.ttl = ttl
+        self.snapshots = snapshots
+        self.metrics = metrics
+        self.shared_seen = {} # {시트: (조회 시각, 공유 세대)}
+        self.lock = threading.Lock()
+        self.load_locks = {name: threading.Lock() for name in SHEET_COLS}
+        self.refreshing = set()
+        self.entries = {}
+        self.gens = {name: 0 for name in SHEET_COLS}
+        self.seq = 0 # 프레임이 바뀔 때마다 증가 (파생 인덱스의 재계산 기준)
+
+    def generation(self, sheet_name):
+        return self.gens.get(sheet_name, 0)
+
+    def version(self, sheet_name):
+        entry = self.entries.get(sheet_name)
+        return entry["version"] if entry else None
+
+    def _store(self, sheet_name, gen, df, marker, checked=None, shared=None):
+        # shared = (이 프레임이 해당하는 공유 세대, 공유본 저장 시각)
+        prev = self.entries.get(sheet_name)
+        if prev is None or prev["df"] is not df: self.seq += 1
+        entry = {"gen": gen, "checked": checked or time.time(), "df": df, "version": self.seq, "marker": marker, "shared": shared}
+        self.entries[sheet_name] = entry
+        return entry
+
+    def restore(self):
+        # 스냅샷을 '만료된' 항목으로 올림 -> 첫 조회는 즉시 응답, 원본과의 대조는 백그라운드에서
+        if self.snapshots is None: return
+        for name in SHEET_COLS:
+            try: loaded = self.snapshots.load(name)
+            except Exception: loaded = None
+            if loaded is None: continue
+            df, meta = loaded
+            with self.lock:
+                if name not in self.entries: self._store(name, self.generation(name), df, meta["marker"], min(meta["saved"], time.time() - self.ttl), (meta.get("gen", 0), meta["saved"]))
+
+    def _shared_gen(self, sheet_name, fresh=False):
+        # 공유 세대 (매 조회마다 읽지 않도록 SHARED_POLL_SEC 동안 memo). 공유 캐시가 없거나 못 읽으면 None
+        if self.snapshots is None: return None
+        seen = self.shared_seen.get(sheet_name)
+        if fresh or seen is None or time.time() - seen[0] > SHARED_POLL_SEC:
+            try: seen = (time.time(), self.snapshots.generation(sheet_name))
+            except Exception: seen = (time.time(), None)
+            self.shared_seen[sheet_name] = seen
+        return seen[1]
+
+    def _in_sync(self, sheet_name, entry):
+        gen = self._shared_gen(sheet_name)
+        return gen is None or (entry["shared"] or (None,))[0] == gen
+
+    @contextlib.contextmanager
+    def shared_lock(self, sheet_name):
+        # 공유 잠금은 선택 사항: lock()은 제너레이터라 오류가 진입(__enter__) 시점에 나므로 거기서 잡고 잠금 없이 진행
+        with contextlib.ExitStack() as stack:
+            try: stack.enter_context(self.snapshots.lock(sheet_name) if self.snapshots is not None else contextlib.nullcontext())
+            except Exception: stack.enter_context(contextlib.nullcontext())
+            yield
+
+    def _adopt(self, sheet_name, entry, shared_gen):
+        # 다른 프로세스가 같은 세대를 TTL 안에 원본과 대조해 두었으면 그것을 씀 -> (df, 마커, 대조 시각, shared) 또는 None
+        if shared_gen is None: return None
+        try:
+            info = self.snapshots.info(sheet_name)
+            if info is None or info["gen"] != shared_gen or time.time() - info["checked"] >= self.ttl: return None
+            if entry and entry["shared"] == (shared_gen, info["saved"]): return entry["df"], entry["marker"], info["checked"], entry["shared"] # 이미 같은 내용
+            loaded = self.snapshots.load(sheet_name)
+        except Exception: return None
+        if loaded is None: return None
+        df, meta = loaded
+        return df, meta["marker"], info["checked"], (shared_gen, meta["saved"])
+
+    def _persist(self, sheet_name, prev, entry, shared_gen):
+        # 원본에서 받은 프레임을 공유본으로 저장 (내용이 그대로면 대조 시각만 갱신)
+        if self.snapshots is None: return
+        try:
+            if prev is not None and prev["df"] is entry["df"] and prev["marker"] == entry["marker"] and prev["shared"] and prev["shared"][0] == shared_gen:
+                self.snapshots.mark_checked(sheet_name)
+                shared = prev["shared"]
+            else:
+                shared = (shared_gen or 0, self.snapshots.save(sheet_name, entry["df"], entry["marker"], shared_gen or 0))
+        except Exception: return # 디스크/Redis 문제로 서비스가 멈추면 안 됨
+        with self.lock: entry["shared"] = shared
+
+    def publish(self, sheet_name):
+        # 쓰기 반영 후: 공유 세대를 올려 다른 프로세스가 다시 읽게 함. 내 프레임이 직전 공유본 + 내 변경뿐이면 그대로 공유
+        if self.snapshots is None: return
+        try:
+            with self.snapshots.lock(sheet_name):
+                current = self.snapshots.generation(sheet_name)
+                new = self.snapshots.bump(sheet_name)
+                self.shared_seen[sheet_name] = (time.time(), new)
+                entry = self.entries.get(sheet_name)
+                if entry and entry["shared"] and entry["shared"][0] == current:
+                    saved = self.snapshots.save(sheet_name, entry["df"], entry["marker"], new)
+                    with self.lock: entry["shared"] = (new, saved)
+        except Exception: pass
+
+    def get(self, sheet_name):
+        entry = self.entries.get(sheet_name)
+        if entry and entry["gen"] == self.generation(sheet_name) and time.time() - entry["checked"] < self.ttl and self._in_sync(sheet_name, entry): return entry["df"]
+        return None
+
+    def age(self):
+        # 가장 오래된 스냅샷이 마지막으로 확인된 뒤 지난 시간(초). 로드된 시트가 없으면 None
+        checked = [entry["checked"] for entry in list(self.entries.values()) if entry["checked"]]
+        return time.time() - min(checked) if checked else None
+
+    def _count(self, name, **labels):
+        if self.metrics: self.metrics.inc(name, **labels)
+
+    @staticmethod
+    def _loaded(marker, at=None):
+        # 마커에 마지막 전체 로드 시각을 붙여 둠 (스냅샷에도 함께 저장돼 재시작/공유본 채택 후에도 유지)
+        return dict(marker, loaded=time.time() if at is None else at) if marker is not None else None
+
+    def _refresh(self, sheet_name, loader, syncer, force=False):
+        # load_lock을 잡은 상태에서 호출: 공유본 채택 -> 안 되면 원본에서 delta 동기화 -> 안 되면 전체 로드
+        gen = self.generation(sheet_name)
+        entry = self.entries.get(sheet_name)
+        with self.shared_lock(sheet_name): # 같은 세대는 프로세스들 중 한 곳만 원본에서 받음
+            shared_gen = self._shared_gen(sheet_name, fresh=True)
+            adopted = None if force else self._adopt(sheet_name, entry, shared_gen)
+            if adopted is not None:
+                df, marker, checked, shared = adopted
+                self._count("cache_refreshes", sheet=sheet_name, source="shared")
+            else:
+                result = None
+                if syncer and entry and entry["gen"] == gen and entry["marker"] is not None and time.time() - entry["marker"].get("loaded", 0) < RECONCILE_SEC:
+                    result = syncer(entry["df"], entry["marker"])
+                if result is not None: df, marker = result[0], self._loaded(result[1], entry["marker"].get("loaded", 0))
+                else:
+                    df, marker = loader()
+                    marker = self._loaded(marker)
+                checked, shared = None, None
+                self._count("cache_refreshes", sheet=sheet_name, source="delta" if result is not None else "full")
+            with self.lock:
+                stored = self._store(sheet_name, gen, df, marker, checked, shared) if gen == self.generation(sheet_name) else None
+            if stored is not None and adopted is None: self._persist(sheet_name, entry, stored, shared_gen)
+        return df
+
+    def _revalidate(self, sheet_name, loader, syncer):
+        try:
+            with self.load_locks.setdefault(sheet_name, threading.Lock()):
+                if self.get(sheet_name) is None: self._refresh(sheet_name, loader, syncer)
+        except Exception:
+            pass # 실패하면 기존 스냅샷을 계속 제공 (실패 횟수는 차단기가 기록)
+        finally:
+            with self.lock: self.refreshing.discard(sheet_name)
+
+    def get_or_load(self, sheet_name, loader, syncer=None):
+        # loader() -> (df, marker), syncer(df, marker) -> (df, marker) 또는 None(전체 로드 필요)
+        df = self.get(sheet_name)
+        if df is not None:
+            self._count("cache_requests", sheet=sheet_name, result="hit"); return df
+        entry = self.entries.get(sheet_name)
+        if entry and entry["gen"] == self.generation(sheet_name) and not entry.get("forced") and self._in_sync(sheet_name, entry):
+            self._count("cache_requests", sheet=sheet_name, result="stale")
+            with self.lock:
+                start = sheet_name not in self.refreshing
+                self.refreshing.add(sheet_name)
+            if start: threading.Thread(target=self._revalidate, args=(sheet_name, loader, syncer), name=f"refresh-{sheet_name}", daemon=True).start()
+            return entry["df"]
+        self._count("cache_requests", sheet=sheet_name, result="miss")
+        with self.load_locks.setdefault(sheet_name, threading.Lock()): # 스냅샷이 없거나 새로고침 요청/다른 프로세스의 쓰기: 기다려서 받음
+            df = self.get(sheet_name)
+            if df is not None: return df
+            try:
+                return self._refresh(sheet_name, loader, syncer, force=bool(entry and entry.get("forced")))
+            except Exception:
+                stale = self.entries.get(sheet_name)
+                if stale and stale["gen"] == self.generation(sheet_name): return stale["df"]
+                raise
+
+    def missing(self):
+        return [name for name in SHEET_COLS if name not in self.entries]
+
+    def load_many(self, sheet_names, loader):
+        # 콜드 스타트용: 비어 있는 시트들을 한 번에 받아 채움. loader(names) -> {시트: (df, 마커)}
+        locks = [self.load_locks.setdefault(name, threading.Lock()) for name in sorted(sheet_names)]
+        for lock in locks: lock.acquire()
+        try:
+            names = [name for name in sheet_names if name not in self.entries]
+            if not names: return
+            for name in names: self._count("cache_requests", sheet=name, result="miss")
+            gens = {name: self.generation(name) for name in names}
+            shared_gens = {name: self._shared_gen(name, fresh=True) for name in names}
+            loaded = loader(names)
+            with self.lock:
+                stored = {name: self._store(name, gens[name], loaded[name][0], self._loaded(loaded[name][1])) for name in loaded if gens[name] == self.generation(name)}
+            for name, entry in stored.items(): self._persist(name, None, entry, shared_gens[name])
+        finally:
+            for lock in reversed(locks): lock.release()
+
+    def apply(self, sheet_name, fn):
+        # write-through: 캐시된 프레임이 있으면 방금 쓴 내용을 반영한 새 프레임으로 교체
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            self.gens[sheet_name] = self.generation(sheet_name) + 1
+            if entry and entry["gen"] + 1 == self.gens[sheet_name]:
+                self._store(sheet_name, self.gens[sheet_name], fn(entry["df"]), entry["marker"], entry["checked"], entry["shared"])
+            else:
+                self.entries.pop(sheet_name, None)
+
+    def expire(self, sheet_name=None):
+        # 스냅샷은 남겨 둔 채 다음 조회에서 바로 다시 확인 (실패하면 기존 스냅샷 유지)
+        with self.lock:
+            for name in ([sheet_name] if sheet_name else list(self.entries)):
+                if name in self.entries: self.entries[name] = dict(self.entries[name], checked=0, forced=True)
+
+    def invalidate(self, sheet_name=None, propagate=False):
+        # propagate=True면 공유 세대도 올려 다른 프로세스도 다시 읽게 함
+        names = [sheet_name] if sheet_name else list(self.gens)
+        with self.lock:
+            for name in names:
+                self.gens[name] = self.generation(name) + 1
+                self.entries.pop(name, None)
+        if propagate and self.snapshots is not None:
+            for name in names:
+                try:
+                    with self.snapshots.lock(name): self.shared_seen[name] = (time.time(), self.snapshots.bump(name))
+                except Exception: pass
+
+@st.cache_resource
+def get_cache():
+    cache = SheetCache(ttl=10, snapshots=get_snapshots(), metrics=get_metrics())
+    cache.restore()
+    return cache
+
+def _appended(df, sheet_name, rows):
+    new = _typed(sheet_name, pd.DataFrame([{c: r.get(c, "") for c in dict.fromkeys(list(SHEET_COLS[sheet_name]) + list(r))} for r in rows]))
+    df, new = _aligned(df.copy(), new)
+    return pd.concat([df, new])
+
+def _patched(df, sheet_name, changes):
+    # changes = {키: {컬럼: 값}} -> 값은 스키마 타입으로 바꿔서 해당 셀만 교체
+    patch = _typed(sheet_name, pd.DataFrame.from_dict({str(k): v for k, v in changes.items()}, orient="index"))
+    df = df.copy()
+    for col in patch.columns:
+        if col not in df.columns: df[col] = ""
+    df, patch = _aligned(df, patch)
+    for key, cols in changes.items():
+        rows = df.index == str(key)
+        for col in cols: df.loc[rows, col] = patch.at[str(key), col]
+    return df
+
+def _merged(df, sheet_name, changed):
+    # 키 기준 병합: 기존 행은 제자리 교체, 새 키는 뒤에 추가
+    if changed.empty: return df
+    if not df.index.is_unique: return None
+    changed = changed[~changed.index.duplicated(keep='last')]
+    df = df.copy()
+    for col in changed.columns:
+        if col not in df.columns: df[col] = ""
+    df, changed = _aligned(df, changed.copy())
+    hit = changed.index.isin(df.index)
+    if hit.any():
+        for col in changed.columns: df.loc[changed.index[hit], col] = changed.loc[hit, col]
+    return pd.concat([df, changed[~hit]])
+
+def _without(df, sheet_name, keys):
+    return df[~df.index.isin({str(k) for k in keys})]
+
+# === [안정화] 데이터 로드 (백오프 재시도 + 차단기 + 캐시) ===
+RETRY_ATTEMPTS = 3
+RETRY_BASE_SEC, RETRY_CAP_SEC = 0.5, 30 # 지수 백오프 시작/상한
+BREAKER_FAILS, BREAKER_COOLDOWN_SEC = 5, 60 # 연속 실패 횟수 / 차단 유지 시간
+
+class CircuitOpen(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    # 연속 실패가 fails번이면 cooldown 동안 호출을 바로 거절(open), 이후 시험 호출 1건만 통과(half-open)
+    def __init__(self, fails=BREAKER_FAILS, cooldown=BREAKER_COOLDOWN_SEC, metrics=None):
+        self.fails, self.cooldown, self.metrics = fails, cooldown, metrics
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.time() - self.opened_at < self.cooldown
+
+    def call(self, fn):
+        with self.lock:
+            if self.is_open:
+                if self.metrics: self.metrics.inc("breaker_rejections")
+                raise CircuitOpen(f"연결 차단 중 (마지막 오류: {self.last_error})")
+            if self.opened_at is not None: self.opened_at = time.time() # half-open: 시험 호출 동안 다른 호출은 계속 차단
+        try:
+            result = fn()
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+                self.last_error = e
+                if self.failures >= self.fails:
+                    if self.opened_at is None and self.metrics: self.metrics.inc("breaker_opens")
+                    self.opened_at = time.time()
+            raise
+        with self.lock:
+            self.failures, self.opened_at, self.last_error = 0, None, None
+        return result
+
+@st.cache_resource
+def get_breaker():
+    return CircuitBreaker(metrics=get_metrics())
+
+def _retry_delay(attempt, error):
+    # full jitter 지수 백오프. 429(요청 한도 초과)는 Retry-After를 따르고, 없으면 더 길게 쉼
+    # 어느 쪽이든 RETRY_CAP_SEC를 넘기지 않음 (캐시 미스 경로는 화면 스레드에서 기다리므로)
+    delay = random.uniform(0, min(RETRY_CAP_SEC, RETRY_BASE_SEC * 2 ** attempt))
+    if isinstance(error, gspread.exceptions.APIError) and error.response.status_code == 429:
+        after = error.response.headers.get("Retry-After", "")
+        delay = max(delay, float(after) if after.isdigit() else 2 ** (attempt + 2))
+    return min(RETRY_CAP_SEC, delay)
+
+def _call(breaker, fn):
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return breaker.call(fn)
+        except CircuitOpen:
+            raise
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1: raise
+            if breaker.metrics: breaker.metrics.inc("retries", status=getattr(getattr(e, "response", None), "status_code", "error"))
+            time.sleep(_retry_delay(attempt, e))
+
+# 아래 로더는 백그라운드 갱신 스레드에서도 돌기 때문에 store/breaker를 인자로 받음
+def _fetch(store, breaker, sheet_name):
+    # 마커와 데이터를 같은 요청으로 받아 그 사이 변경을 놓치지 않음
+    return _call(breaker, lambda: store.load_many([sheet_name])[sheet_name])
+
+def _fetch_many(store, breaker, sheet_names):
+    return _call(breaker, lambda: store.load_many(sheet_names))
+
+def _sync(store, breaker, sheet_name, df, marker):
+    # 변경 마커 확인 -> 그대로면 재사용, rev만 올랐으면 바뀐 행만 병합, epoch가 바뀌면 전체 로드
+    try:
+        current = _call(breaker, lambda: store.marker(sheet_name))
+        if current is None or current["epoch"] != marker["epoch"]: return None
+        if current["rev"] <= marker["rev"]: return df, current
+        changed = _call(breaker, lambda: store.load_since(sheet_name, marker["rev"]))
+        merged = _merged(df, sheet_name, changed) if changed is not None else None
+        return (merged, current) if merged is not None else None
+    except (CircuitOpen, gspread.exceptions.APIError, OSError): # 일시 오류에 전체 로드로 넘어가면 한도만 더 씀 -> 기존 스냅샷 유지
+        raise
+    except Exception:
+        return None
+
+def _frame(sheet_name):
+    # 캐시 공유 프레임 (읽기 전용으로 사용). 처음 읽을 때는 비어 있는 시트를 모두 한 번에 받아옴
+    cache, store, breaker = get_cache(), get_store(), get_breaker()
+    if sheet_name in SHEET_COLS and sheet_name not in cache.entries:
+        try: cache.load_many(cache.missing(), lambda names: _fetch_many(store, breaker, names))
+        except Exception: pass
+    try: return cache.get_or_load(sheet_name, lambda: _fetch(store, breaker, sheet_name), lambda df, marker: _sync(store, breaker, sheet_name, df, marker))
+    except Exception: return pd.DataFrame(columns=SHEET_COLS.get(sheet_name, []))
+
+@_timed("load_data")
 def load_data(sheet_name):
-    target_cols = []
-    if sheet_name == "resources": target_cols = COLS_RESOURCES
-    elif sheet_name == "users": target_cols = COLS_USERS
-    elif sheet_name == "messages": target_cols = COLS_MESSAGES
+    return _frame(sheet_name).copy(deep=False) # copy-on-write: 고쳐 쓰는 순간에만 실제 복사
+
+# === [쓰기] write-behind 큐 (모든 세션의 변경을 모아 배치 반영) ===
+WRITE_FLUSH_SEC = 0.3
+WRITE_RETOUCH_SEC = 5 # 마커 갱신이 실패하면 이만큼 뒤에 다시 큐에 넣음
+
+class WriteBehind:
+    # 변경(append/update/delete/rewrite)을 큐에 넣으면 백그라운드 스레드가 WRITE_FLUSH_SEC 동안 모아서
+    # 시트별 순서대로, 연속된 같은 종류끼리 합쳐 API 호출 1회로 반영. submit()은 Future를 돌려줌
+    def __init__(self, store, cache, breaker=None, interval=WRITE_FLUSH_SEC):
+        self.store, self.cache, self.breaker, self.interval = store, cache, breaker, interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.counts = {} # 시트별 미반영 건수
+        self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def submit(self, op, sheet_name, payload):
+        future = concurrent.futures.Future()
+        with self.lock: self.counts[sheet_name] = self.counts.get(sheet_name, 0) + 1
+        self.queue.put((op, sheet_name, payload, future))
+        return future
+
+    def pending(self, sheet_name=None):
+        with self.lock: return self.counts.get(sheet_name, 0) if sheet_name else sum(self.counts.values())
+
+    def flush(self, timeout=None):
+        # 지금까지 넣은 변경이 모두 반영될 때까지 대기
+        return self.submit("noop", None, None).result(timeout)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(timeout=10)
 
-    for attempt in range(3): # 3회 재시도
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is None: break
+            batch = [item]
+            time.sleep(self.interval)
+            while True:
+                try: item = self.queue.get_nowait()
+                except queue.Empty: break
+                if item is None: stop = True; break
+                batch.append(item)
+            self._apply(batch)
+
+    def _apply(self, batch):
+        by_sheet = {}
+        for item in batch: by_sheet.setdefault(item[1], []).append(item)
+        for sheet_name, items in by_sheet.items():
+            groups = []
+            for item in items:
+                if groups and groups[-1][0][0] == item[0] and item[0] in ("append", "update", "delete"): groups[-1].append(item)
+                else: groups.append([item])
+            for group in groups: self._apply_group(sheet_name, group)
+
+    def _locked(self, sheet_name):
+        # 프로세스 간 시트별 쓰기 잠금: 키 열을 읽고 행 번호로 수정/삭제하는 사이에 다른 워커가 행을 옮기지 못하게.
+        # 조회용 잠금과 이름을 나눠 원본 로드와 쓰기가 서로 기다리지 않음 (공유 캐시가 없으면 잠금 없음)
+        return self.cache.shared_lock(f"{sheet_name}.write") if sheet_name else contextlib.nullcontext()
+
+    def _write(self, op, sheet_name, group):
+        # updated_at은 큐에 넣은 시각이 아니라 실제로 쓰는 시각 -> 백오프로 늦게 반영돼도 다른 프로세스의 delta 범위 안에 들어감
+        stamp = _now_ms()
+        if op == "append":
+            self.store.append(sheet_name, [dict(r, updated_at=stamp) for g in group for r in g[2]])
+        elif op == "update":
+            merged = {}
+            for g in group:
+                for key, cols in g[2].items(): merged.setdefault(str(key), {}).update(cols, updated_at=stamp)
+            self.store.update(sheet_name, merged)
+        elif op == "delete":
+            self.store.delete(sheet_name, list(dict.fromkeys(str(k) for g in group for k in g[2])))
+        elif op == "rewrite":
+            self.store.rewrite(sheet_name, group[-1][2])
+
+    def _retried(self, fn):
+        # 다시 보내도 결과가 같은 호출만: 일시 오류(429/5xx)는 백오프 재시도 (잠금은 시도마다 잡아 대기 중에는 풀어 둠)
+        return _call(self.breaker, fn) if self.breaker else fn()
+
+    def _apply_group(self, sheet_name, group):
+        # group 항목: (op, 시트, payload, Future). 다시 큐에 넣은 마커 갱신("touch")은 Future가 없음
+        op = group[0][0]
+        replayed = False
+        try:
+            try:
+                write = lambda: self._locked_call(sheet_name, lambda: self._write(op, sheet_name, group))
+                if op in ("update", "delete", "rewrite"): self._retried(write)
+                elif op == "append": write() # 다시 보내면 행이 중복될 수 있어 재시도하지 않음
+            except Exception:
+                if len(group) == 1: raise
+                # 여러 세션의 변경을 합친 배치가 실패하면 하나씩 다시 반영 -> 문제 있는 변경만 실패
+                replayed = True
+                for item in group: self._apply_group(sheet_name, [item])
+                return
+            for g in group:
+                if g[3] is not None: g[3].set_result(True)
+        except Exception as e:
+            self.cache.invalidate(sheet_name, propagate=True) # 낙관적으로 반영한 캐시(와 공유본)를 버리고 원본을 다시 읽게 함
+            for g in group:
+                if g[3] is not None: g[3].set_exception(e)
+            return
+        finally:
+            if not replayed:
+                with self.lock: self.counts[sheet_name] = max(0, self.counts.get(sheet_name, 0) - sum(g[3] is not None for g in group))
+        if op != "noop": self._touch(sheet_name, op in ("delete", "rewrite") or (op == "touch" and group[0][2]))
+
+    def _locked_call(self, sheet_name, fn):
+        with self._locked(sheet_name): return fn()
+
+    def _touch(self, sheet_name, destructive):
+        # 데이터는 이미 반영됨: 마커 갱신이 끝내 실패해도 쓰기를 실패로 알리지 않고, 잠시 뒤 마커 갱신만 다시 시도
+        # (그때까지 다른 프로세스는 변경을 못 보지만, 캐시를 버려 봐야 마커가 그대로라 달라지지 않음)
         try:
-            sh = connect_google_sheet()
-            worksheet = sh.worksheet(sheet_name)
-            data = worksheet.get_all_records()
-            if not data: return pd.DataFrame(columns=target_cols)
-            df = pd.DataFrame(data)
-            for col in target_cols:
-                if col not in df.columns: df[col] = ""
-            if 'id' in df.columns: df['id'] = df['id'].astype(str)
-            return df
+            self._retried(lambda: self._locked_call(sheet_name, lambda: self.store.touch(sheet_name, _now_ms(), destructive=destructive)))
         except Exception:
-            time.sleep(1)
-            continue
-    return pd.DataFrame(columns=target_cols)
+            timer = threading.Timer(WRITE_RETOUCH_SEC, self.queue.put, args=[("touch", sheet_name, destructive, None)])
+            timer.daemon = True
+            timer.start()
+            return
+        self.cache.publish(sheet_name) # 다른 프로세스에도 알림
+
+@st.cache_resource(on_release=lambda writer: writer.close())
+def get_writer():
+    return WriteBehind(get_store(), get_cache(), get_breaker())
+
+def _submit(op, sheet_name, payload):
+    future = get_writer().submit(op, sheet_name, payload)
+    st.session_state.setdefault('pending_writes', []).append((sheet_name, future))
+    return future
 
-# === 데이터 저장 ===
+def report_write_status():
+    # 이 세션에서 넣은 변경 중 실패한 것은 알리고, 끝난 것은 정리
+    pending = []
+    for sheet_name, future in st.session_state.get('pending_writes', []):
+        if not future.done(): pending.append((sheet_name, future))
+        elif future.exception() is not None: st.error(f"저장 실패 ({sheet_name}): {future.exception()}")
+    st.session_state['pending_writes'] = pending
+    return len(pending)
+
+# === 단건 조회 (인덱스 엔진은 포인트 쿼리, 시트 엔진은 캐시 프레임 필터) ===
+@_timed("query_data")
+def query_data(sheet_name, **where):
+    store = get_store()
+    if store.indexed:
+        try:
+            if get_writer().pending(sheet_name): get_writer().flush(timeout=10) # 큐에 남은 내 변경부터 반영
+            return store.find(sheet_name, **where)
+        except Exception: return pd.DataFrame(columns=SHEET_COLS.get(sheet_name, []))
+    df = _frame(sheet_name)
+    key = SHEET_KEYS.get(sheet_name)
+    if key in where: # 키는 인덱스 해시 조회
+        k = str(where.pop(key))
+        df = df.loc[[k]] if k in df.index else df.iloc[:0]
+    if df.empty or not where: return df
+    mask = pd.Series(True, index=df.index)
+    for col, val in where.items(): mask &= df[col].astype(str) == str(val)
+    return df[mask]
+
+# === 데이터 저장 (쓴 시트만 무효화 + write-through) ===
+@_timed("append_data")
+def append_data(sheet_name, rows, wait=None):
+    # wait: 초 단위로 주면 원본 반영까지 기다림 (일괄 등록의 진행률 표시용)
+    try:
+        rev = _now_ms()
+        rows = [dict(r, updated_at=rev) for r in rows]
+        future = _submit("append", sheet_name, rows)
+        get_cache().apply(sheet_name, lambda df: _appended(df, sheet_name, rows))
+        if wait: future.result(timeout=wait)
+        return True
+    except Exception as e:
+        st.error(f"저장 실패: {e}"); return False
+
+@_timed("update_data")
+def update_data(sheet_name, changes):
+    try:
+        rev = _now_ms()
+        changes = {k: dict(v, updated_at=rev) for k, v in changes.items()}
+        _submit("update", sheet_name, changes)
+        get_cache().apply(sheet_name, lambda df: _patched(df, sheet_name, changes))
+        return True
+    except Exception as e:
+        st.error(f"저장 실패: {e}"); return False
+
+@_timed("delete_data")
+def delete_data(sheet_name, keys):
+    try:
+        _submit("delete", sheet_name, list(keys))
+        get_cache().apply(sheet_name, lambda df: _without(df, sheet_name, keys))
+        return True
+    except Exception as e:
+        st.error(f"저장 실패: {e}"); return False
+
+@_timed("save_data")
 def save_data(sheet_name, new_data_dict=None, update_df=None):
+    # 신규 1건은 append, update_df 전체 덮어쓰기는 명시적 정리(compaction) 용도로만 사용
+    if update_df is None:
+        return append_data(sheet_name, [new_data_dict])
     try:
-        sh = connect_google_sheet()
-        worksheet = sh.worksheet(sheet_name)
-        if update_df is not None:
-            df = update_df
-        else:
-            current_data = worksheet.get_all_records()
-            df = pd.DataFrame(current_data)
-            if df.empty:
-                if sheet_name == "resources": df = pd.DataFrame(columns=COLS_RESOURCES)
-                elif sheet_name == "users": df = pd.DataFrame(columns=COLS_USERS)
-                elif sheet_name == "messages": df = pd.DataFrame(columns=COLS_MESSAGES)
-            new_row = pd.DataFrame([new_data_dict])
-            df = pd.concat([df, new_row], ignore_index=True)
-        
-        worksheet.clear()
-        worksheet.update([df.columns.values.tolist()] + df.astype(str).values.tolist())
-        st.cache_data.clear() # 캐시 초기화
+        _submit("rewrite", sheet_name, update_df.copy())
+        get_cache().apply(sheet_name, lambda df: _typed(sheet_name, _encoded(sheet_name, update_df)))
+        return True
     except Exception as e:
-        st.error(f"저장 실패: {e}")
+        st.error(f"저장 실패: {e}"); return False
+
+# === [검색] 매물 역색인 (한글 n-gram) ===
+SEARCH_FIELDS = {"item": 3.0, "company": 2.0, "category": 1.5, "process": 1.5, "region": 1.0, "desc": 1.0}
+
+@functools.lru_cache(maxsize=65536)
+def _grams(text):
+    # 단어별 1글자 + 2글자 n-gram (한글은 띄어쓰기/조사 변화가 커서 형태소 대신 n-gram 사용)
+    grams = set()
+    for word in text.lower().split():
+        grams.update(word)
+        grams.update(word[i:i + 2] for i in range(len(word) - 1))
+    return frozenset(grams)
+
+def _query_grams(text):
+    grams = set()
+    for word in str(text).lower().split():
+        grams.update([word] if len(word) == 1 else (word[i:i + 2] for i in range(len(word) - 1)))
+    return grams
+
+class SearchIndex:
+    # gram -> {매물 id: 필드 가중치 합}. 데이터 버전이 바뀌면 바뀐 매물만 추가/삭제
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.docs = {}  # id -> (서명, gram 목록)
+        self.version = None
+        self.results = {} # 같은 버전 안에서 반복되는 검색어 결과
+
+    def add(self, doc_id, row, sig=None):
+        weights = {}
+        for field, w in SEARCH_FIELDS.items():
+            for g in _grams(str(row.get(field, ""))): weights[g] = weights.get(g, 0.0) + w
+        for g, w in weights.items(): self.postings.setdefault(g, {})[doc_id] = w
+        self.docs[doc_id] = (sig, list(weights))
+
+    def remove(self, doc_id):
+        _, grams = self.docs.pop(doc_id, (None, []))
+        for g in grams:
+            posting = self.postings.get(g)
+            if posting is None: continue
+            posting.pop(doc_id, None)
+            if not posting: del self.postings[g]
+
+    def sync(self, df, version):
+        with self.lock:
+            if version is not None and version == self.version: return
+            cols = [c for c in SEARCH_FIELDS if c in df.columns]
+            ids = df['id'].tolist() if not df.empty else []
+            sigs = []
+            if ids:
+                joined = df[cols[0]].astype(str)
+                for c in cols[1:]: joined = joined + "\x1f" + df[c].astype(str)
+                sigs = joined.tolist()
+            current = dict(zip(ids, sigs))
+            for doc_id in [d for d, (sig, _) in self.docs.items() if current.get(d) != sig]: self.remove(doc_id)
+            added = [i for i, d in enumerate(ids) if d not in self.docs]
+            if added:
+                rows = df[cols].iloc[added].to_dict("records")
+                for i, row in zip(added, rows): self.add(ids[i], row, sigs[i])
+            self.version = version
+            self.results = {}
+
+    def search(self, query, limit=None):
+        # 모든 질의 gram을 포함하는 매물만, idf 가중 점수 순으로 [(id, 점수)] 반환
+        grams = _query_grams(query)
+        if not grams: return None
+        with self.lock:
+            key = frozenset(grams)
+            if key not in self.results:
+                postings = sorted((self.postings.get(g, {}) for g in grams), key=len)
+                ranked = []
+                if postings[0]:
+                    n = max(len(self.docs), 1)
+                    scores = dict.fromkeys(set(postings[0]).intersection(*postings[1:]), 0.0)
+                    for p in postings:
+                        idf = math.log(1 + n / len(p))
+                        for d in scores: scores[d] += p[d] * idf
+                    ranked = sorted(scores.items(), key=lambda x: -x[1])
+                if len(self.results) > 256: self.results.clear()
+                self.results[key] = ranked
+            ranked = self.results[key]
+        return ranked[:limit] if limit else ranked
+
+@st.cache_resource
+def get_search_index():
+    return SearchIndex()
+
+def search_resources(df, keyword):
+    # 매물 검색: 인덱스를 현재 데이터 버전에 맞춘 뒤 순위대로 정렬된 부분 프레임 반환
+    index = get_search_index()
+    index.sync(_frame("resources"), get_cache().version("resources"))
+    hits = index.search(keyword)
+    if hits is None: return df
+    rank = {doc_id: i for i, (doc_id, _) in enumerate(hits)}
+    order = df['id'].map(rank)
+    return df[order.notna()].iloc[order.dropna().argsort()]
+
+# === [매칭] 팝니다 <-> 삽니다 자동 추천 ===
+MATCH_FIELDS = {"item": 3.0, "process": 1.5, "desc": 1.0}
+MATCH_ROLES = {"팝니다": "삽니다", "삽니다": "팝니다"}
+MATCH_TEXT_W, MATCH_GEO_W = 0.7, 0.3 # 점수 = 텍스트 유사도(TF-IDF 코사인) * 0.7 + 거리 점수 * 0.3
+MATCH_GEO_KM = 50 # 거리 점수가 1/e로 줄어드는 거리
+MATCH_TOP = 5
+MATCH_DRIFT = 0.02 # 계산 뒤 매물 수가 이 비율 넘게 바뀐 추천 목록은 버리고 다시 계산 (idf/노름이 그만큼 달라짐)
+
+class MatchIndex:
+    # 같은 카테고리의 반대 구분 매물끼리 점수화 (같은 작성자의 매물끼리는 제외). 희소 TF-IDF(gram -> {id: tf})를 검색 색인처럼 바뀐 매물만 갱신하고,
+    # 이미 계산한 추천은 새 매물과의 점수만 더해 갱신. 기존 점수는 계산 당시의 idf 기준이라 근사값 ->
+    # 상대가 삭제됐거나 매물 수가 MATCH_DRIFT 넘게 달라진 목록은 다시 계산
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.docs = {}   # id -> (서명, {gram: tf}, 카테고리, 구분, lat, lon, 작성자)
+        self.groups = {} # (카테고리, 구분) -> {id}
+        self.version = None
+        self.matches = {} # id -> [(상대 id, 점수, 거리 km)]
+        self.basis = {}   # id -> 추천 목록을 계산할 때의 매물 수
+        self.norms = {}
+
+    def add(self, doc_id, row, sig=None):
+        tf = {}
+        for field, w in MATCH_FIELDS.items():
+            for g in _grams(str(row.get(field, ""))): tf[g] = tf.get(g, 0.0) + w
+        for g, w in tf.items(): self.postings.setdefault(g, {})[doc_id] = w
+        group = (str(row.get('category')), str(row.get('role')))
+        self.groups.setdefault(group, set()).add(doc_id)
+        self.docs[doc_id] = (sig, tf, group[0], group[1], row.get('lat'), row.get('lon'), str(row.get('writer_id')))
+        return group
+
+    def remove(self, doc_id):
+        _, tf, cat, role, _, _, _ = self.docs.pop(doc_id)
+        for g in tf:
+            posting = self.postings.get(g)
+            if posting is None: continue
+            posting.pop(doc_id, None)
+            if not posting: del self.postings[g]
+        self.groups.get((cat, role), set()).discard(doc_id)
+        return (cat, role)
+
+    def sync(self, df, version):
+        with self.lock:
+            if version is not None and version == self.version: return
+            cols = ['category', 'role', 'lat', 'lon', 'writer_id'] + list(MATCH_FIELDS)
+            ids = df['id'].tolist() if not df.empty else []
+            sigs = []
+            if ids:
+                joined = df[cols[0]].astype(str)
+                for c in cols[1:]: joined = joined + "\x1f" + df[c].astype(str)
+                sigs = joined.tolist()
+            current = dict(zip(ids, sigs))
+            removed = [d for d, (sig, *_) in self.docs.items() if current.get(d) != sig]
+            for doc_id in removed: self.remove(doc_id)
+            added = [i for i, d in enumerate(ids) if d not in self.docs]
+            new = {}
+            if added:
+                rows = df[cols].iloc[added].to_dict("records")
+                for i, row in zip(added, rows): new.setdefault(self.add(ids[i], row, sigs[i]), []).append(ids[i])
+            self.version = version
+            self.norms = {}
+            gone = set(removed)
+            n = len(self.docs)
+            for doc_id in [d for d, top in self.matches.items() if d not in self.docs or any(m[0] in gone for m in top) or abs(n - self.basis[d]) > MATCH_DRIFT * self.basis[d]]:
+                del self.matches[doc_id], self.basis[doc_id]
+            # 점수는 대칭이므로 새 매물 하나당 한 번만 계산해 상대 그룹의 기존 추천 목록에 끼워 넣음
+            for (cat, role), docs in new.items():
+                waiting = [d for d in self.groups.get((cat, MATCH_ROLES.get(role)), ()) if d in self.matches]
+                for doc_id in docs if waiting else ():
+                    others = self._others(doc_id, waiting)
+                    if not others: continue
+                    score, km = self._pairs(doc_id, others)
+                    for d, sc, k in zip(others, score, km):
+                        self.matches[d] = sorted(self.matches[d] + [(doc_id, float(sc), float(k))], key=lambda m: -m[1])[:MATCH_TOP]
+
+    def _idf(self, g):
+        return math.log(1 + len(self.docs) / len(self.postings[g]))
+
+    def _norm(self, doc_id):
+        if doc_id not in self.norms:
+            self.norms[doc_id] = math.sqrt(sum((w * self._idf(g)) ** 2 for g, w in self.docs[doc_id][1].items())) or 1.0
+        return self.norms[doc_id]
+
+    def _others(self, doc_id, cands):
+        # 후보 중 doc_id와 작성자가 다른 매물만 (자기 매물끼리는 거래 상대가 아님)
+        writer = self.docs[doc_id][6]
+        return [d for d in cands if self.docs[d][6] != writer]
+
+    def _pairs(self, doc_id, cands):
+        # -> (점수 배열, 거리 배열) : doc_id 와 후보 매물들 사이
+        _, tf, _, _, lat, lon, _ = self.docs[doc_id]
+        # 텍스트: 질의 매물의 gram 목록만 돌며 후보와의 내적 누적 (희소 벡터 곱)
+        pos = {d: i for i, d in enumerate(cands)}
+        dot = np.zeros(len(cands))
+        for g, w in tf.items():
+            idf = self._idf(g)
+            for d, wd in self.postings[g].items():
+                i = pos.get(d)
+                if i is not None: dot[i] += w * wd * idf * idf
+        text = dot / (self._norm(doc_id) * np.array([self._norm(d) for d in cands]))
+        # 거리: 좌표가 없으면 중립 점수 0.5
+        clat = np.array([self.docs[d][4] for d in cands], dtype=float)
+        clon = np.array([self.docs[d][5] for d in cands], dtype=float)
+        km = haversine_km(clat, clon, lat, lon) if pd.notna(lat) and pd.notna(lon) else np.full(len(cands), np.nan)
+        geo = np.where(np.isnan(km), 0.5, np.exp(-km / MATCH_GEO_KM))
+        return MATCH_TEXT_W * text + MATCH_GEO_W * geo, km
+
+    def _score(self, doc_id):
+        _, _, cat, role, _, _, _ = self.docs[doc_id]
+        cands = self._others(doc_id, self.groups.get((cat, MATCH_ROLES.get(role)), ()))
+        if not cands: return []
+        score, km = self._pairs(doc_id, cands)
+        top = np.argsort(-score, kind="stable")[:MATCH_TOP]
+        return [(cands[i], float(score[i]), float(km[i])) for i in top]
+
+    def top(self, doc_id):
+        with self.lock:
+            if doc_id not in self.docs: return []
+            if doc_id not in self.matches: self.matches[doc_id], self.basis[doc_id] = self._score(doc_id), len(self.docs)
+            return self.matches[doc_id]
+
+@st.cache_resource
+def get_match_index():
+    return MatchIndex()
+
+def listing_matches(doc_id):
+    # -> 추천 상대 매물 프레임 (score, km 열 추가)
+    df = _frame("resources")
+    index = get_match_index()
+    index.sync(df, get_cache().version("resources"))
+    top = [m for m in index.top(doc_id) if m[0] in df.index]
+    if not top: return df.iloc[:0]
+    out = df.loc[[m[0] for m in top]].copy()
+    out['score'], out['km'] = [m[1] for m in top], [m[2] for m in top]
+    return out
+
+# === [지도] 벡터화 마커 + 뷰포트 기반 전송 ===
+MAP_CENTER, MAP_ZOOM = [36.5, 127.8], 7
+MAP_MAX_POINTS = 1500 # 뷰포트 안 매물이 이보다 많으면 격자 요약만 전송
+MARKER_JS = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: 'info-sign', prefix: 'glyphicon', markerColor: row[2]});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup(row[3]);
+    return marker;
+}
+"""
+
+def marker_colors(df):
+    cat = df['category'].astype(str)
+    return np.select([df['role'] == "수거/운송", cat.str.contains("설비"), cat.str.contains("부산물")], ["black", "purple", "red"], "blue")
+
+def map_view():
+    # st_folium(key="main_map")이 마지막으로 돌려준 화면 범위/줌
+    state = st.session_state.get("main_map") or {}
+    center = state.get("center") or {}
+    return {"center": [center.get("lat", MAP_CENTER[0]), center.get("lng", MAP_CENTER[1])], "zoom": state.get("zoom") or MAP_ZOOM, "bounds": state.get("bounds")}
+
+def in_viewport(df, bounds, pad=0.25):
+    sw, ne = (bounds or {}).get("_southWest") or {}, (bounds or {}).get("_northEast") or {}
+    if df.empty or None in (sw.get("lat"), sw.get("lng"), ne.get("lat"), ne.get("lng")): return df
+    dlat, dlon = (ne['lat'] - sw['lat']) * pad, (ne['lng'] - sw['lng']) * pad
+    return df[df['lat'].between(sw['lat'] - dlat, ne['lat'] + dlat) & df['lon'].between(sw['lng'] - dlon, ne['lng'] + dlon)]
+
+def build_map(df, view, tiles, origin=None, radius_km=None):
+    m = folium.Map(location=view['center'], zoom_start=view['zoom'], tiles=tiles)
+    if origin is not None:
+        folium.Marker(origin, tooltip="내 위치", icon=folium.Icon(color="green", icon="home")).add_to(m)
+        if radius_km: folium.Circle(origin, radius=radius_km * 1000, color="#16A34A", fill=False).add_to(m)
+    pts = in_viewport(df, view['bounds'])
+    if pts.empty: return m
+    if len(pts) <= MAP_MAX_POINTS:
+        # 한 번에 [lat, lon, 색, 팝업] 배열로 만들어 브라우저에서 마커 생성
+        popup = "<b>" + pts['item'].astype(str).map(html.escape) + "</b><br>" + pts['company'].astype(str).map(html.escape)
+        if static_serving(): # 팝업 HTML은 열 때 DOM에 들어가므로 사진도 그때 요청됨
+            keys = pts['image_path'].map(_image_key)
+            popup = popup + np.where(keys != "", '<br><img src="app/static/images/thumb/' + keys + '.jpg" loading="lazy" width="160">', "")
+        data = pd.DataFrame({'lat': pts['lat'], 'lon': pts['lon'], 'color': marker_colors(pts), 'popup': popup}).values.tolist()
+        FastMarkerCluster(data, callback=MARKER_JS).add_to(m)
+    else:
+        # 현재 줌 기준 약 60px 격자로 묶어서 건수만 표시
+        cell = 60 * 360 / (256 * 2 ** view['zoom'])
+        g = pts.groupby([pts['lat'] // cell, pts['lon'] // cell]).agg(n=('lat', 'size'), lat=('lat', 'mean'), lon=('lon', 'mean'))
+        for lat, lon, n in zip(g['lat'], g['lon'], g['n']):
+            bubble = f"<div style='background:#1E3A8A;color:#fff;border-radius:50%;width:40px;height:40px;line-height:40px;text-align:center;font-weight:bold;opacity:0.85;'>{n}</div>"
+            folium.Marker([lat, lon], icon=folium.DivIcon(html=bubble, icon_size=(40, 40), icon_anchor=(20, 20)), tooltip=f"{n}건 (확대하면 상세 표시)").add_to(m)
+    return m
+
+# === [리스트] 정렬 / 페이지 / 요청 상태 ===
+LIST_SORTS = ["관련도순", "최신순", "거리순", "인증회원 우선"]
+LIST_PAGE_SIZES = [10, 20, 50]
+
+def haversine_km(lat, lon, lat0, lon0):
+    # 벡터화 대원거리 (km)
+    lat, lon = np.radians(np.asarray(lat, dtype=float)), np.radians(np.asarray(lon, dtype=float))
+    lat0, lon0 = np.radians(lat0), np.radians(lon0)
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat) * np.cos(lat0) * np.sin((lon - lon0) / 2) ** 2
+    return 6371.0 * 2 * np.arcsin(np.sqrt(a))
+
+# === [위치] 격자 공간 인덱스 (반경 검색) ===
+GEO_CELL_DEG = 0.05 # 격자 한 칸 (위도 기준 약 5.5km)
+NEAR_RADII = [5, 10, 30, 50, 100] # km
+
+class GeoIndex:
+    # 좌표를 격자 칸 번호 순으로 정렬해 두고, 반경을 덮는 칸 구간만 이진 탐색 -> 후보만 정확한 거리 계산
+    def __init__(self, df, cell=GEO_CELL_DEG):
+        self.cell = cell
+        ok = (df['lat'].notna() & df['lon'].notna()).to_numpy()
+        lat, lon = df['lat'].to_numpy(dtype=float)[ok], df['lon'].to_numpy(dtype=float)[ok]
+        cells = self._cell_id(np.floor(lat / cell), np.floor(lon / cell))
+        order = np.argsort(cells, kind="stable")
+        self.cells, self.lat, self.lon, self.keys = cells[order], lat[order], lon[order], df.index.to_numpy()[ok][order]
+
+    @staticmethod
+    def _cell_id(i, j):
+        return (np.asarray(i, dtype=np.int64) + 4000) * 8000 + (np.asarray(j, dtype=np.int64) + 4000)
+
+    def within(self, lat0, lon0, km):
+        # -> 반경 km 안의 매물 {키: 거리(km)}, 가까운 순
+        dlat = km / 111.0
+        dlon = km / max(111.0 * math.cos(math.radians(lat0)), 1e-6)
+        rows = np.arange(math.floor((lat0 - dlat) / self.cell), math.floor((lat0 + dlat) / self.cell) + 1)
+        lo = np.searchsorted(self.cells, self._cell_id(rows, math.floor((lon0 - dlon) / self.cell)), "left")
+        hi = np.searchsorted(self.cells, self._cell_id(rows, math.floor((lon0 + dlon) / self.cell)), "right")
+        idx = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)]) if len(rows) else np.array([], dtype=int)
+        dist = haversine_km(self.lat[idx], self.lon[idx], lat0, lon0)
+        hit = dist <= km
+        return pd.Series(dist[hit], index=self.keys[idx[hit]]).sort_values(kind="stable")
+
+def my_location(user_id):
+    # 기준 위치: 지도에서 클릭한 곳 > 내가 마지막으로 등록한 매물(공장) 위치 > 없음
+    if st.session_state.get('my_location'): return st.session_state['my_location'], "지도에서 선택한 위치"
+    mine = query_data("resources", writer_id=user_id).dropna(subset=['lat', 'lon'])
+    if mine.empty: return None, None
+    last = mine.sort_values('date', na_position='first').iloc[-1]
+    return [float(last['lat']), float(last['lon'])], f"내 매물 '{last['item']}' 위치"
+
+def sort_listings(df, order, origin=None, distances=None):
+    # distances: 반경 검색에서 이미 계산한 {키: km} (있으면 거리순에 그대로 사용)
+    if df.empty or order == "관련도순": return df
+    if order == "거리순" and distances is not None:
+        return df.iloc[np.argsort(distances.reindex(df.index).to_numpy(), kind="stable")]
+    if order == "최신순":
+        return df.sort_values(['date', 'id'], ascending=False, na_position='last', kind='stable') # 날짜 없는 매물은 맨 뒤로
+    if order == "거리순" and origin is not None:
+        return df.iloc[np.argsort(haversine_km(df['lat'], df['lon'], origin[0], origin[1]), kind="stable")]
+    if order == "인증회원 우선":
+        return df.iloc[np.argsort(~df['verified'].to_numpy(), kind="stable")]
+    return df
+
+def get_geo_index():
+    return derived("geo_index", ["resources"], GeoIndex)
+
+def request_status_map(user_id):
+    # 현재 사용자가 보낸 요청을 item_id -> status 로 한 번만 정리 (매물마다 메시지 스캔 X)
+    mine = query_data("messages", from_user=user_id)
+    if mine.empty: return {}
+    mine = mine.drop_duplicates('item_id')
+    return dict(zip(mine['item_id'], mine['status']))
+
+# === [거래] 메시지 ⋈ 매물 ⋈ 보낸 사람 (데이터 버전당 1회) ===
+@st.cache_resource
+def get_derived():
+    return {}
+
+def derived(name, sheets, builder):
+    # 의존 시트들의 데이터 버전이 그대로면 이전 계산 결과 재사용
+    frames = [_frame(s) for s in sheets]
+    versions = tuple(get_cache().version(s) for s in sheets)
+    memo = get_derived()
+    hit = memo.get(name)
+    if hit and hit[0] == versions and None not in versions: return hit[1]
+    result = builder(*frames)
+    memo[name] = (versions, result)
+    return result
+
+def _build_board(msgs, res, users):
+    items = res[['id', 'item', 'company', 'contact']].drop_duplicates('id').rename(columns={'id': 'item_id', 'item': 'item_name', 'company': 'item_company', 'contact': 'item_contact'})
+    senders = users[['user_id', 'company_name']].drop_duplicates('user_id').rename(columns={'user_id': 'from_user', 'company_name': 'sender_company'})
+    board = msgs.reset_index(drop=True).merge(items, on='item_id', how='left').merge(senders, on='from_user', how='left')
+    board['sender_company'] = board['sender_company'].fillna(board['from_user'])
+    return board, board.groupby('from_user').indices, board.groupby('to_user').indices
+
+def message_board(user_id, side):
+    # side = 'from_user'(보낸 요청) / 'to_user'(받은 요청)
+    board, by_from, by_to = derived("message_board", ["messages", "resources", "users"], _build_board)
+    rows = (by_from if side == 'from_user' else by_to).get(str(user_id), [])
+    return board.iloc[rows]
 
 def hash_password(password): return hashlib.sha256(password.encode()).hexdigest()
 
+def _fmt_date(value, fmt):
+    return "" if pd.isna(value) else value.strftime(fmt)
+
 # === [데이터] 산단 DB ===
 REGION_DB = {
     "수도권 (서울/경기/인천)": [37.4, 127.0],
@@ -188,6 +1791,7 @@ REGION_DB = {
 }
 # [수정] 요청하신 '분석/기타' 반영
 CATEGORIES = ["🏭 유휴설비", "🧪 화학부산물", "📦 자재/스크랩", "🚛 수거/운송", "📊 분석/기타"]
+ROLES = ["팝니다", "삽니다", "수거/운송", "기타"]
 
 # --- 법적 책임 고지 ---
 def render_legal_notice():
@@ -238,14 +1842,11 @@ def login_page():
                     upw = st.text_input("비밀번호", type="password")
                     if st.form_submit_button("로그인", use_container_width=True):
                         try:
-                            users = load_data("users")
                             c_uid, c_pw = uid.strip(), upw.strip()
                             hashed = hash_password(c_pw)
                             
                             # 일반 로그인
-                            user = pd.DataFrame()
-                            if not users.empty:
-                                user = users[(users['user_id'] == c_uid) & (users['password_hash'] == hashed)]
+                            user = query_data("users", user_id=c_uid, password_hash=hashed)
                             
                             if not user.empty:
                                 st.session_state['logged_in'] = True
@@ -255,7 +1856,7 @@ def login_page():
                             # 관리자 강제 복구
                             elif c_uid == "admin" and c_pw == "1234":
                                 admin_data = {"user_id": "admin", "password_hash": hash_password("1234"), "company_name": "관리자", "contact": "system", "biz_no": "-", "is_verified": "TRUE", "deal_count": 999, "reputation": 100.0, "join_date": datetime.now().strftime("%Y-%m-%d")}
-                                if users.empty or "admin" not in users['user_id'].values:
+                                if query_data("users", user_id="admin").empty:
                                     save_data("users", new_data_dict=admin_data)
                                 st.session_state.update({'logged_in': True, 'user_id': "admin", 'is_admin': True})
                                 st.success("관리자 접속 성공"); time.sleep(1); st.rerun()
@@ -271,10 +1872,9 @@ def login_page():
                     comp_name = st.text_input("기업명")
                     if st.form_submit_button("가입신청", use_container_width=True):
                         try:
-                            users = load_data("users")
                             if not new_id.strip() or not new_pw.strip() or not contact.strip():
                                 st.error("필수 항목 누락")
-                            elif not users.empty and new_id.strip() in users['user_id'].values:
+                            elif not query_data("users", user_id=new_id.strip()).empty:
                                 st.error("이미 존재하는 아이디")
                             else:
                                 new_user = {"user_id": new_id.strip(), "password_hash": hash_password(new_pw.strip()), "company_name": comp_name.strip() or "개인회원", "contact": contact.strip(), "biz_no": "-", "is_verified": "FALSE", "deal_count": 0, "reputation": 36.5, "join_date": datetime.now().strftime("%Y-%m-%d")}
@@ -283,29 +1883,523 @@ def login_page():
                         except Exception as e: st.error(f"오류: {e}")
     render_footer()
 
+# --- 상호작용 위젯 (fragment: 클릭하면 해당 컴포넌트만 다시 실행) ---
+# 버튼은 on_click 콜백으로 저장하고 결과를 세션에 기록 -> fragment 재실행 때 바로 반영
+def _send_request(row):
+    new_msg = {"req_id": _new_key(), "from_user": st.session_state['user_id'], "to_user": row['writer_id'], "item_id": str(row['id']), "status": "requested", "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M")}
+    if save_data("messages", new_data_dict=new_msg): st.session_state.setdefault('sent_requests', {})[str(row['id'])] = "requested"
+
+@st.fragment
+def contact_request_button(row, status):
+    if status is None: status = st.session_state.get('sent_requests', {}).get(str(row['id']))
+    if status is None:
+        st.button("💬 연락처 요청 (클릭)", key=f"req_{row['id']}", type="primary", use_container_width=True, on_click=_send_request, args=(row,))
+    elif status == 'approved': st.success("✅ 승인됨! 메시지함 확인")
+    elif status == 'rejected': st.error("❌ 거절됨")
+    else: st.warning("⏳ 승인 대기 중")
+
+def _answer_request(req_id, status):
+    if update_data("messages", {req_id: {'status': status}}): st.session_state.setdefault('inbox_status', {})[str(req_id)] = status
+
+@st.fragment
+def inbox_actions(row):
+    status = st.session_state.get('inbox_status', {}).get(str(row['req_id']), row['status'])
+    if status == 'requested':
+        c1, c2 = st.columns(2)
+        c1.button("수락", key=f"y_{row['req_id']}", on_click=_answer_request, args=(row['req_id'], 'approved'))
+        c2.button("거절", key=f"n_{row['req_id']}", on_click=_answer_request, args=(row['req_id'], 'rejected'))
+    else: st.write(f"상태: {status}")
+
+def _delete_listing(item_id):
+    if delete_data("resources", [item_id]): st.session_state.setdefault('deleted_items', set()).add(str(item_id))
+
+@st.fragment
+def delete_listing_button(r):
+    if str(r['id']) in st.session_state.get('deleted_items', set()): st.success("삭제됨"); return
+    st.button("🗑️ 삭제", key=f"del_{r['id']}", on_click=_delete_listing, args=(r['id'],))
+
+# --- 탭별 화면 (선택된 탭만 실행) ---
+def render_map_tab(curr_user):
+    df = load_data("resources")
+    clicked = (st.session_state.get("main_map") or {}).get("last_clicked")
+    if clicked: st.session_state['my_location'] = [clicked['lat'], clicked['lng']]
+    origin, origin_label = my_location(st.session_state['user_id'])
+
+    with st.container(border=True):
+        c_search, c_filter = st.columns([2, 1])
+        with c_search: search_kw = st.text_input("🔍 통합 검색", placeholder="품목, 기업, 내용 등")
+        with c_filter: f_role = st.multiselect("거래 구분", ["팝니다", "삽니다", "수거/운송", "기타"])
+        c1, c2 = st.columns(2)
+        with c1: f_region = st.multiselect("📍 지역", list(REGION_DB.keys()))
+        with c2: f_cat = st.multiselect("📦 카테고리", list(CATEGORIES))
+        c3, c4 = st.columns([1, 2])
+        with c3: radius = st.selectbox("📏 내 위치 반경", [None] + NEAR_RADII, format_func=lambda r: "전체" if r is None else f"{r}km 이내", key="near_km")
+        with c4: st.caption(f"기준: {origin_label} (지도를 클릭하면 바뀝니다)" if origin else "지도를 클릭해 기준 위치를 지정하세요")
+
+    tile = "CartoDB dark_matter" if st.session_state['dark_mode'] else "OpenStreetMap"
+
+    filtered = df
+    if not df.empty and 'lat' in df.columns:
+        filtered = df.dropna(subset=['lat', 'lon'])
+        if search_kw: filtered = search_resources(filtered, search_kw)
+        if f_region: filtered = filtered[filtered['region'].isin(f_region)]
+        if f_cat: filtered = filtered[filtered['category'].isin(f_cat)]
+        if f_role: filtered = filtered[filtered['role'].isin(f_role)]
+    near = None
+    if radius and origin and not filtered.empty:
+        near = get_geo_index().within(origin[0], origin[1], radius)
+        filtered = filtered[filtered.index.isin(near.index)]
+
+    with get_metrics().timed("build_map"): m = build_map(filtered, map_view(), tile, origin, radius)
+    st_folium(m, key="main_map", width=1000, height=400, returned_objects=["bounds", "zoom", "center", "last_clicked"])
+    st.subheader(f"📋 매물 리스트 ({len(filtered)}건)")
+
+    if filtered.empty: st.info("매물이 없습니다.")
+    else:
+        c_sort, c_size, c_page = st.columns([2, 1, 1])
+        with c_sort: order = st.selectbox("정렬", LIST_SORTS, key="list_sort")
+        with c_size: page_size = st.selectbox("페이지당", LIST_PAGE_SIZES, key="list_size")
+        pages = max(1, math.ceil(len(filtered) / page_size))
+        if st.session_state.get("list_page", 1) > pages: st.session_state["list_page"] = pages
+        with c_page: page = st.number_input("페이지", 1, pages, key="list_page")
+
+        with get_metrics().timed("render_listings"):
+            ordered = sort_listings(filtered, order, origin or map_view()['center'], near)
+            my_status = request_status_map(st.session_state['user_id'])
+            for idx, row in ordered.iloc[(page - 1) * page_size : page * page_size].iterrows():
+                label = f"[{row['role']}] {row['item']} - {row['company']}"
+                if near is not None: label += f" · {near.get(idx, 0):.1f}km"
+                with st.expander(label):
+                    st.markdown(f"#### 🏭 {row['item']}")
+                    show_image(row['image_path'])
+                    c1, c2 = st.columns(2)
+                    with c1: st.write(f"**지역:** {row['region']}"); st.write(f"**카테고리:** {row['category']}")
+                    with c2: 
+                        st.write(f"**등록일:** {_fmt_date(row['date'], DATE_FORMATS['date'])}")
+                        ver = "✅ 인증회원" if row['verified'] else "미인증"
+                        st.write(f"**상태:** {ver}")
+                    st.divider()
+                    if row['process']: st.info(f"**공정:** {row['process']}")
+                    st.write(row['desc'])
+                    st.divider()
+
+                    if row['writer_id'] == st.session_state['user_id']:
+                        st.button("내 글", disabled=True, key=f"my_{row['id']}")
+                    else:
+                        contact_request_button(row, my_status.get(str(row['id'])))
+
+# === [일괄] 매물 가져오기/내보내기 ===
+IMPORT_FIELDS = ["region", "role", "category", "item", "desc", "process", "company", "contact", "complex", "lat", "lon"]
+IMPORT_CHUNK = 200 # append 1회(시트 API 호출 1회)에 담는 행 수
+IMPORT_MAX_ROWS = 5000
+EXPORT_CHUNK = 1000
+
+def read_upload(upload):
+    # CSV(UTF-8 또는 엑셀 기본 CP949) / 엑셀(openpyxl 필요) -> 모든 값을 문자열로
+    if upload.name.lower().endswith((".xlsx", ".xlsm")):
+        return pd.read_excel(upload, dtype=str).fillna("")
+    try: return pd.read_csv(upload, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    except UnicodeDecodeError:
+        upload.seek(0)
+        return pd.read_csv(upload, dtype=str, keep_default_na=False, encoding="cp949")
+
+def prepare_import(raw, curr_user, verified):
+    # -> (등록할 행 프레임, 오류 행 프레임). 검증/좌표/id 부여를 열 단위로 한 번에 처리
+    raw = raw.rename(columns=lambda c: str(c).strip())
+    df = raw.reindex(columns=IMPORT_FIELDS, fill_value="").astype(str).apply(lambda col: col.str.strip())
+    df['company'] = df['company'].mask(df['company'] == "", curr_user.get('company_name', ''))
+    df['contact'] = df['contact'].mask(df['contact'] == "", curr_user.get('contact', ''))
+    # 카테고리는 이모지 없이 적어도 인정 (CP949 엑셀에서는 이모지를 저장할 수 없음)
+    df['category'] = df['category'].map({c.split(" ", 1)[-1]: c for c in CATEGORIES}).fillna(df['category'])
+    lat, lon = pd.to_numeric(df['lat'], errors="coerce"), pd.to_numeric(df['lon'], errors="coerce")
+    errors = pd.Series("", index=df.index)
+    for bad, msg in [((df['item'] == "") | (df['desc'] == ""), "제목/내용 누락"),
+                     (~df['region'].isin(list(REGION_DB)), "알 수 없는 권역"),
+                     (~df['role'].isin(ROLES), "알 수 없는 구분"),
+                     (~df['category'].isin(CATEGORIES), "알 수 없는 카테고리"),
+                     (((df['lat'] != "") & ~lat.between(-90, 90)) | ((df['lon'] != "") & ~lon.between(-180, 180)), "좌표 형식 오류")]:
+        errors = errors.mask(bad & (errors == ""), msg)
+    ok = (errors == "").to_numpy()
+    # 좌표가 없으면 권역 중심 + 임의 오차 (단건 등록과 같은 규칙)
+    jitter = np.random.uniform(-0.1, 0.1, (len(df), 2))
+    missing = lat.isna() | lon.isna()
+    lat = lat.where(~missing, df['region'].map({k: v[0] for k, v in REGION_DB.items()}) + jitter[:, 0])
+    lon = lon.where(~missing, df['region'].map({k: v[1] for k, v in REGION_DB.items()}) + jitter[:, 1])
+    rows = df[ok].assign(lat=lat[ok], lon=lon[ok])
+    # id: 단건 등록과 같은 형식 (밀리초 + 임의 6자리) -> 다른 세션/프로세스의 동시 등록과도 겹치지 않음
+    rows.insert(0, 'id', _new_keys(len(rows)))
+    rows = rows.assign(writer_id=st.session_state['user_id'], date=datetime.now().strftime("%Y-%m-%d"), verified="TRUE" if verified else "FALSE", image_path="")
+    report = raw[~ok].assign(오류=errors[~ok])
+    report.index = report.index + 2 # 파일 기준 행 번호 (1행은 머리글)
+    return rows, report
+
+def import_listings(rows, progress):
+    # IMPORT_CHUNK 행씩 append -> 반영될 때마다 진행률 갱신
+    records = rows.to_dict("records")
+    for i in range(0, len(records), IMPORT_CHUNK):
+        if not append_data("resources", records[i:i + IMPORT_CHUNK], wait=120): return i
+        done = min(i + IMPORT_CHUNK, len(records))
+        progress.progress(done / len(records), text=f"{done:,} / {len(records):,}건 저장")
+    return len(records)
+
+def csv_export(df, cols, date_format=None):
+    # download_button에 넘기는 지연 생성 함수: 클릭할 때 EXPORT_CHUNK 행씩 인코딩 (엑셀 호환 UTF-8 BOM)
+    df = df.reset_index(drop=True)[cols]
+    def build():
+        buf = io.BytesIO()
+        buf.write("\ufeff".encode())
+        for i in range(0, max(len(df), 1), EXPORT_CHUNK):
+            buf.write(df.iloc[i:i + EXPORT_CHUNK].to_csv(index=False, header=i == 0, date_format=date_format).encode())
+        return buf.getvalue()
+    return build
+
+def render_bulk_import(curr_user):
+    with st.expander("📥 일괄 등록 (CSV / Excel)"):
+        st.caption(f"열 이름: {', '.join(IMPORT_FIELDS)} · 제목(item)과 내용(desc)은 필수, 좌표가 없으면 권역 중심 부근으로 표시 · 최대 {IMPORT_MAX_ROWS:,}건")
+        template = pd.DataFrame([dict(zip(IMPORT_FIELDS, [list(REGION_DB)[0], ROLES[0], CATEGORIES[0], "500L 반응기", "사용 3년, 상태 양호", "", "", "", "", "", ""]))])
+        st.download_button("양식 내려받기", csv_export(template, IMPORT_FIELDS), file_name="factory_link_import.csv", mime="text/csv")
+        upload = st.file_uploader("파일 선택", type=["csv", "xlsx", "xlsm"], key="bulk_upload")
+        if upload is None: return
+        try: raw = read_upload(upload)
+        except ImportError: st.error("엑셀 파일을 읽으려면 openpyxl이 필요합니다. CSV로 저장해서 올려주세요."); return
+        except Exception as e: st.error(f"파일을 읽지 못했습니다: {e}"); return
+        if len(raw) > IMPORT_MAX_ROWS: st.error(f"한 번에 {IMPORT_MAX_ROWS:,}건까지 등록할 수 있습니다. (현재 {len(raw):,}건)"); return
+        verified = bool(st.session_state.get('is_admin') or curr_user.get('is_verified'))
+        rows, report = prepare_import(raw, curr_user, verified)
+        st.write(f"등록 가능 **{len(rows):,}건** · 오류 {len(report):,}건")
+        if not report.empty: st.dataframe(report, use_container_width=True)
+        if st.session_state.get('bulk_done') == upload.file_id: st.info("이 파일은 이미 등록했습니다."); return
+        if not rows.empty and st.button(f"{len(rows):,}건 등록", type="primary", key="bulk_import"):
+            progress = st.progress(0.0, text="저장 중...")
+            saved = import_listings(rows, progress)
+            if saved: st.session_state['bulk_done'] = upload.file_id
+            if saved == len(rows): st.success(f"{saved:,}건 등록 완료!")
+            else: st.warning(f"{saved:,}건까지 등록하고 중단했습니다.")
+
+# === [사진] 업로드 -> 고정 크기 변환 -> 내용 해시 이름으로 저장 ===
+# 시트에는 사진 키(내용 해시)만 기록. 같은 사진은 한 번만 저장되고 파일 이름이 바뀌지 않아 브라우저가 오래 캐시
+IMG_MAX_BYTES = 10 * 2 ** 20
+IMG_MAX_PIXELS = 40_000_000 # 압축 폭탄 방지
+IMG_SIZES = {"thumb": 240, "preview": 1024} # 긴 변 기준 px
+IMG_QUALITY = 82
+IMG_CACHE_BYTES = 64 * 2 ** 20
+
+def _image_key(value):
+    # 시트 값 -> 올바른 사진 키 또는 "" (경로 조작 방지)
+    value = str(value or "")
+    return value if re.fullmatch(r"[0-9a-f]{24}", value) else ""
+
+def _image_file(key, size):
+    return os.path.join(IMG_DIR, size, f"{key}.jpg")
+
+def store_image(data):
+    # 원본 바이트 -> 사진 키. 원본은 보관하지 않고 IMG_SIZES 크기의 JPEG만 저장
+    if len(data) > IMG_MAX_BYTES: raise ValueError(f"사진은 {IMG_MAX_BYTES // 2 ** 20}MB 이하만 올릴 수 있습니다.")
+    key = hashlib.sha256(data).hexdigest()[:24]
+    if all(os.path.exists(_image_file(key, size)) for size in IMG_SIZES): return key
+    try:
+        with Image.open(io.BytesIO(data)) as src:
+            if src.width * src.height > IMG_MAX_PIXELS: raise ValueError("사진 해상도가 너무 큽니다.")
+            img = ImageOps.exif_transpose(src).convert("RGB")
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"사진을 읽지 못했습니다: {e}")
+    for size, edge in IMG_SIZES.items():
+        out = img.copy()
+        out.thumbnail((edge, edge), Image.LANCZOS)
+        path = _image_file(key, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 세션은 같은 프로세스의 스레드이므로 임시 파일 이름에 스레드 id까지 넣음 -> 같은 사진을 동시에 올려도 서로의 임시 파일을 덮지 않고,
+        # 교체는 원자적이라 읽는 쪽은 항상 완전한 파일만 봄
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        out.save(tmp, "JPEG", quality=IMG_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp, path)
+    return key
+
+class ImageCache:
+    # 디스크에서 읽은 사진 바이트의 LRU (전체 크기 상한)
+    def __init__(self, budget=IMG_CACHE_BYTES):
+        self.budget, self.used = budget, 0
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+
+    def get(self, key, size):
+        k = (key, size)
+        with self.lock:
+            if k in self.items:
+                self.items.move_to_end(k); return self.items[k]
+        try:
+            with open(_image_file(key, size), "rb") as f: data = f.read()
+        except OSError: return None
+        with self.lock:
+            if k not in self.items:
+                self.items[k] = data
+                self.used += len(data)
+                while self.used > self.budget and len(self.items) > 1:
+                    _, old = self.items.popitem(last=False)
+                    self.used -= len(old)
+        return data
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache()
+
+def static_serving():
+    # .streamlit/config.toml 의 server.enableStaticServing (켜져 있으면 static/ 아래 파일을 app/static/... 로 제공)
+    return bool(st.get_option("server.enableStaticServing"))
+
+def image_url(key, size):
+    # 정적 파일 제공이 켜져 있을 때만 URL (브라우저가 직접 받으므로 서버 세션을 거치지 않음)
+    if key and static_serving(): return f"app/static/images/{size}/{key}.jpg"
+    return None
+
+def show_image(value, width=IMG_SIZES["thumb"]):
+    # 썸네일 표시: 정적 URL이면 <img loading="lazy">(펼친 패널에서만 요청, 누르면 미리보기), 아니면 LRU 캐시 바이트
+    key = _image_key(value)
+    if not key: return
+    url = image_url(key, "thumb")
+    if url:
+        st.markdown(f'<a href="{image_url(key, "preview")}" target="_blank"><img src="{url}" loading="lazy" width="{width}" style="border-radius:6px"></a>', unsafe_allow_html=True)
+        return
+    data = get_image_cache().get(key, "thumb")
+    if data: st.image(data, width=width)
+
+def render_register_tab(curr_user):
+    st.subheader("📝 신규 매물 등록")
+    c1, c2 = st.columns(2)
+    with c1: region = st.selectbox("권역", list(REGION_DB.keys()))
+    with c2: role = st.selectbox("구분", ROLES)
+    cat = st.selectbox("카테고리", CATEGORIES)
+
+    title = st.text_input("제목 (예: 500L 반응기)")
+    proc = st.text_input("공정 스펙 (선택)")
+    desc = st.text_area("상세 내용 (상태, 가격 등)", height=150)
+    st.divider()
+    company = st.text_input("기업명", value=curr_user.get('company_name',''))
+    contact = st.text_input("연락처", value=curr_user.get('contact',''))
+
+    # 정확한 위치: 지도 클릭 (선택하지 않으면 권역 중심 부근 임의 위치)
+    picked = (st.session_state.get("reg_map") or {}).get("last_clicked")
+    st.caption(f"📍 선택한 위치: {picked['lat']:.5f}, {picked['lng']:.5f}" if picked else "📍 지도를 클릭해 정확한 위치를 지정하세요 (선택 안 하면 권역 중심 부근으로 표시)")
+    reg_map = folium.Map(location=[picked['lat'], picked['lng']] if picked else REGION_DB[region], zoom_start=12 if picked else 9, tiles="CartoDB dark_matter" if st.session_state['dark_mode'] else "OpenStreetMap")
+    if picked: folium.Marker([picked['lat'], picked['lng']]).add_to(reg_map)
+    st_folium(reg_map, key="reg_map", width=1000, height=300, returned_objects=["last_clicked"])
+    photo = st.file_uploader(f"사진 (선택, {IMG_MAX_BYTES // 2 ** 20}MB 이하)", type=["jpg", "jpeg", "png", "webp"], key="reg_photo", max_upload_size=IMG_MAX_BYTES // 2 ** 20)
+    if photo is not None: st.image(photo, width=IMG_SIZES["thumb"])
+
+    if st.button("등록 완료", type="primary", use_container_width=True):
+        if not title or not desc: st.error("제목과 내용은 필수입니다.")
+        else:
+            try: image_key = store_image(photo.getvalue()) if photo is not None else ""
+            except ValueError as e: st.error(str(e)); return
+            if picked: lat, lon = picked['lat'], picked['lng']
+            else:
+                lat = REGION_DB[region][0] + random.uniform(-0.1, 0.1)
+                lon = REGION_DB[region][1] + random.uniform(-0.1, 0.1)
+            is_ver = "TRUE" if (st.session_state.get('is_admin') or curr_user.get('is_verified')) else "FALSE"
+            new_data = {"id": _new_key(), "writer_id": st.session_state['user_id'], "date": datetime.now().strftime("%Y-%m-%d"), "company": company, "contact": contact, "region": region, "role": role, "category": cat, "item": title, "lat": lat, "lon": lon, "desc": desc, "process": proc, "verified": is_ver, "image_path": image_key}
+            save_data("resources", new_data_dict=new_data)
+            st.success("등록됨!"); st.balloons(); time.sleep(1); st.rerun()
+
+    st.divider()
+    render_bulk_import(curr_user)
+
+def render_deals_tab(curr_user):
+    st.subheader("📂 내 거래 관리")
+    my_res = query_data("resources", writer_id=st.session_state['user_id'])
+    my_req = message_board(st.session_state['user_id'], 'from_user')
+    my_req = my_req[my_req['item_name'].notna()] # 삭제된 매물 제외
+    c1, c2, _ = st.columns([1, 1, 2])
+    c1.download_button("📤 내 매물 CSV", csv_export(_encoded("resources", my_res), [c for c in COLS_RESOURCES if c != 'updated_at']), file_name="my_listings.csv", mime="text/csv", disabled=my_res.empty)
+    c2.download_button("📥 내 요청 CSV", csv_export(my_req, ['req_id', 'item_id', 'item_name', 'item_company', 'status', 'timestamp'], DATE_FORMATS['datetime']), file_name="my_requests.csv", mime="text/csv", disabled=my_req.empty)
+    ts, tb = st.tabs(["📤 판매 내역", "📥 구매/요청 내역"], key="deal_tab", on_change="rerun")
+    if ts.open:
+        with ts:
+            if my_res.empty: st.info("등록된 매물이 없습니다.")
+            else:
+                for _, r in my_res.iterrows():
+                    with st.expander(f"[{r['role']}] {r['item']}"):
+                        st.write(r['desc'])
+                        if r['role'] in MATCH_ROLES:
+                            matches = listing_matches(r['id'])
+                            st.markdown("**🤝 추천 상대**" if not matches.empty else "🤝 아직 맞는 상대 매물이 없습니다.")
+                            for m in matches.to_dict("records"):
+                                dist = "" if pd.isna(m['km']) else f" · {m['km']:.1f}km"
+                                st.caption(f"[{m['role']}] {m['item']} - {m['company']} ({m['region']}){dist} · 적합도 {m['score']:.0%}")
+                        delete_listing_button(r)
+    if tb.open:
+        with tb:
+            if my_req.empty: st.info("요청 내역이 없습니다.")
+            else:
+                for req in my_req.to_dict("records"):
+                    stat = req['status']
+                    color = "status-wait" if stat=='requested' else "status-ok" if stat=='approved' else "status-no"
+                    txt = "승인 대기" if stat=='requested' else "승인됨" if stat=='approved' else "거절됨"
+                    cont = f"📞 {req['item_contact']}" if stat=='approved' else "🔒 비공개"
+                    
+                    with st.container(border=True):
+                        c1, c2 = st.columns([3, 1])
+                        c1.markdown(f"**{req['item_name']}** ({req['item_company']})")
+                        c1.markdown(f"👉 {cont}")
+                        c2.markdown(f'<span class="status-badge {color}">{txt}</span>', unsafe_allow_html=True)
+
+def render_inbox_tab(curr_user):
+    st.subheader("🔔 수신 메시지함")
+    my_in = message_board(st.session_state['user_id'], 'to_user')
+    my_in = my_in[my_in['item_name'].notna()] # 삭제된 매물 제외
+
+    if my_in.empty: st.info("받은 요청이 없습니다.")
+    else:
+        for row in my_in.to_dict("records"):
+            with st.expander(f"🔔 {row['sender_company']} -> {row['item_name']}"):
+                st.caption(f"요청 시간: {_fmt_date(row['timestamp'], DATE_FORMATS['datetime'])}")
+                inbox_actions(row)
+
+# === [관리자] 서버 측 필터/페이지 + 바뀐 셀만 저장 ===
+ADMIN_PAGE_SIZE = 50
+ADMIN_USER_COLS = ["user_id", "company_name", "contact", "biz_no", "is_verified", "deal_count", "reputation", "join_date"] # 비밀번호 해시는 내보내지 않음
+ADMIN_RES_COLS = ["id", "writer_id", "date", "company", "region", "role", "category", "item", "verified"]
+
+def admin_page(df, key, sort_col):
+    # 필터된 프레임 -> (현재 페이지, 전체 건수). 브라우저로는 한 페이지만 전송
+    pages = max(1, math.ceil(len(df) / ADMIN_PAGE_SIZE))
+    if st.session_state.get(key, 1) > pages: st.session_state[key] = pages
+    c1, c2 = st.columns([1, 3])
+    page = c1.number_input("페이지", 1, pages, key=key)
+    c2.caption(f"{len(df):,}건 · {pages:,}쪽")
+    top = df.sort_values(sort_col, ascending=False, kind="stable", na_position="last") if len(df) > ADMIN_PAGE_SIZE else df
+    return top.iloc[(page - 1) * ADMIN_PAGE_SIZE : page * ADMIN_PAGE_SIZE]
+
+def editor_key(prefix, *state):
+    # 필터/페이지가 바뀌거나 반영한 뒤에는 새 편집기 (이전 페이지의 편집/선택이 다른 행에 옮겨 붙지 않도록)
+    return f"{prefix}_{abs(hash(tuple(map(str, state)) + (st.session_state.get('adm_nonce', 0),)))}"
+
+def admin_done(message=None):
+    st.session_state['adm_nonce'] = st.session_state.get('adm_nonce', 0) + 1
+    if message: st.toast(message)
+    st.rerun()
+
+def page_changes(sheet_name, before, after, cols):
+    # 편집 전/후 페이지 -> {키: {컬럼: 새 값}} (바뀐 셀만)
+    key = SHEET_KEYS[sheet_name]
+    keys = before[key].astype(str).to_numpy()
+    changes = {}
+    for col in cols:
+        a, b = before[col].astype(object).reset_index(drop=True), after[col].astype(object).reset_index(drop=True)
+        changed = ~((a == b) | (a.isna() & b.isna()))
+        for i in np.flatnonzero(changed.to_numpy(dtype=bool)): changes.setdefault(keys[i], {})[col] = b.iloc[i]
+    return changes
+
+def render_admin_users():
+    st.caption("회원 관리 (필터와 페이지는 서버에서 처리, 저장은 바뀐 칸만)")
+    users = load_data("users")
+    c1, c2, c3 = st.columns([1, 2, 2])
+    ver = c1.selectbox("인증", ["전체", "인증", "미인증"], key="adm_u_ver")
+    joined = c2.date_input("가입일", value=[], key="adm_u_join")
+    kw = c3.text_input("아이디/기업명", key="adm_u_kw").strip()
+    mask = pd.Series(True, index=users.index)
+    if ver != "전체": mask &= users['is_verified'] == (ver == "인증")
+    if len(joined) == 2: mask &= users['join_date'].between(pd.Timestamp(joined[0]), pd.Timestamp(joined[1]))
+    if kw: mask &= users['user_id'].str.contains(kw, case=False, regex=False) | users['company_name'].str.contains(kw, case=False, regex=False)
+    page = admin_page(users[mask], "adm_u_page", "join_date")[ADMIN_USER_COLS]
+    view = page.reset_index(drop=True)
+    view.insert(0, "선택", False)
+    edited = st.data_editor(view, hide_index=True, disabled=["user_id", "join_date"], key=editor_key("adm_u_edit", ver, joined, kw, st.session_state["adm_u_page"]),
+                            column_config={"is_verified": st.column_config.CheckboxColumn("인증"), "선택": st.column_config.CheckboxColumn("선택")})
+    picked = edited.loc[edited['선택'], 'user_id'].tolist()
+    c1, c2, c3, c4 = st.columns(4)
+    if c1.button("변경 저장", key="adm_u_save"):
+        changes = page_changes("users", view, edited, [c for c in ADMIN_USER_COLS if c not in ("user_id", "join_date")])
+        if changes and update_data("users", changes): admin_done(f"{len(changes)}명 수정")
+        elif not changes: st.info("바뀐 내용이 없습니다.")
+    if c2.button("선택 인증", key="adm_u_verify", disabled=not picked):
+        update_data("users", {u: {'is_verified': True} for u in picked}); admin_done(f"{len(picked)}명 인증")
+    if c3.button("선택 인증 해제", key="adm_u_unverify", disabled=not picked):
+        update_data("users", {u: {'is_verified': False} for u in picked}); admin_done(f"{len(picked)}명 인증 해제")
+    if c4.button("선택 회원 매물 모두 삭제", key="adm_u_purge", disabled=not picked):
+        res = load_data("resources")
+        keys = res.index[res['writer_id'].isin(picked)].tolist()
+        if keys and delete_data("resources", keys): admin_done(f"매물 {len(keys):,}건 삭제")
+        elif not keys: st.info("삭제할 매물이 없습니다.")
+
+def render_admin_resources():
+    st.caption("매물 관리")
+    res = load_data("resources")
+    c1, c2, c3 = st.columns([1, 2, 2])
+    ver = c1.selectbox("인증", ["전체", "인증", "미인증"], key="adm_r_ver")
+    cats = c2.multiselect("카테고리", CATEGORIES, key="adm_r_cat")
+    writer = c3.text_input("작성자 아이디", key="adm_r_writer").strip()
+    mask = pd.Series(True, index=res.index)
+    if ver != "전체": mask &= res['verified'] == (ver == "인증")
+    if cats: mask &= res['category'].isin(cats)
+    if writer: mask &= res['writer_id'] == writer
+    page = admin_page(res[mask], "adm_r_page", "date")[ADMIN_RES_COLS]
+    view = page.reset_index(drop=True)
+    view.insert(0, "선택", False)
+    edited = st.data_editor(view, hide_index=True, disabled=[c for c in ADMIN_RES_COLS if c not in ("item", "verified")], key=editor_key("adm_r_edit", ver, cats, writer, st.session_state["adm_r_page"]),
+                            column_config={"verified": st.column_config.CheckboxColumn("인증"), "선택": st.column_config.CheckboxColumn("선택")})
+    picked = edited.loc[edited['선택'], 'id'].tolist()
+    c1, c2, _ = st.columns([1, 1, 2])
+    if c1.button("변경 저장", key="adm_r_save"):
+        changes = page_changes("resources", view, edited, ["item", "verified"])
+        if changes and update_data("resources", changes): admin_done(f"{len(changes)}건 수정")
+        elif not changes: st.info("바뀐 내용이 없습니다.")
+    if c2.button("선택 삭제", key="adm_r_delete", disabled=not picked):
+        delete_data("resources", picked); admin_done(f"{len(picked)}건 삭제")
+
+def render_admin_tab(curr_user):
+    st.subheader("⚙️ 관리자")
+    render_admin_users()
+
+    st.divider()
+    st.caption("비밀번호 리셋")
+    with st.form("pw_rst"):
+        u = st.text_input("ID").strip()
+        p = st.text_input("새 비번", value="1234")
+        if st.form_submit_button("변경"):
+            if query_data("users", user_id=u).empty: st.error("없는 아이디입니다.")
+            else: update_data("users", {u: {'password_hash': hash_password(p)}}); st.success("변경됨")
+
+    st.divider()
+    render_admin_resources()
+
+    st.divider()
+    metrics = get_metrics()
+    st.caption(f"📈 성능 계측 (이 서버 프로세스, {datetime.fromtimestamp(metrics.since).strftime('%m-%d %H:%M')} 이후 누적)")
+    requests = metrics.total("cache_requests")
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("시트 API 호출", f"{metrics.total('api_calls'):,}", f"오류 {metrics.total('api_errors'):,} · 저장소 호출 {metrics.total('store_calls'):,}", delta_color="off")
+    c2.metric("재시도", f"{metrics.total('retries'):,}", f"429 {metrics.total('retries', status=429):,}", delta_color="off")
+    c3.metric("캐시 적중률", f"{metrics.total('cache_requests', result='hit') / requests:.0%}" if requests else "-", f"만료본 제공 {metrics.total('cache_requests', result='stale'):,}", delta_color="off")
+    c4.metric("차단기 열림", f"{metrics.total('breaker_opens'):,}", f"거절 {metrics.total('breaker_rejections'):,}", delta_color="off")
+    timings, counts = metrics.timings(), metrics.counts()
+    if not timings.empty: st.dataframe(timings, hide_index=True, use_container_width=True)
+    if not counts.empty: st.dataframe(counts, hide_index=True, use_container_width=True)
+    c1, c2, c3 = st.columns(3)
+    c1.download_button("Prometheus 텍스트", metrics.prometheus(), file_name="factory_link_metrics.txt", mime="text/plain")
+    c2.download_button("JSON", metrics.to_json(), file_name="factory_link_metrics.json", mime="application/json")
+    if c3.button("계측 초기화"): metrics.reset(); st.rerun()
+
 # [3] 메인 앱
 def main_app():
     # CSS 적용 (다크 모드 반영)
     apply_css(st.session_state['dark_mode'])
     
-    users = load_data("users")
     curr_user = pd.Series()
-
-    if not users.empty:
-        user_rows = users[users['user_id'] == st.session_state['user_id']]
-        if not user_rows.empty: curr_user = user_rows.iloc[0]
+    user_rows = query_data("users", user_id=st.session_state['user_id'])
+    if not user_rows.empty: curr_user = user_rows.iloc[0]
     
     # 안정화: 데이터 로드 실패 시 재시도 유도
     if curr_user.empty:
         if st.session_state['user_id'] == 'admin':
-            curr_user = pd.Series({'company_name': '관리자', 'contact': 'system', 'is_verified': 'TRUE'})
-        elif users.empty:
+            curr_user = pd.Series({'company_name': '관리자', 'contact': 'system', 'is_verified': True})
+        elif get_cache().version("users") is None or _frame("users").empty: # 한 번도 못 받았으면 로그아웃시키지 않음
             st.warning("⚠️ 서버 연결 중... (잠시 후 다시 시도해주세요)")
-            if st.button("🔄 연결 재시도"): st.cache_data.clear(); st.rerun()
+            if st.button("🔄 연결 재시도"): get_cache().invalidate(); st.rerun()
             return
         else:
             st.error("회원 정보 오류. 다시 로그인해주세요."); time.sleep(2); st.session_state['logged_in'] = False; st.rerun(); return
 
+    pending = report_write_status()
     with st.sidebar:
         try:
             with st.container(border=True):
@@ -316,8 +2410,13 @@ def main_app():
                     if st.session_state.get('is_admin'): st.caption("👑 관리자")
                     else: st.caption(f"⭐ 신뢰도: {curr_user.get('reputation', 36.5)}")
             
+            if pending: st.caption(f"⏳ 저장 중 {pending}건")
+            age = get_cache().age()
+            if get_breaker().is_open: st.caption("⚠️ 서버 응답 지연 - 마지막 저장본을 표시 중입니다")
+            if age is not None: st.caption(f"🕒 데이터 기준: {int(age)}초 전")
+
             # 인증 배지
-            if str(curr_user.get('is_verified', 'FALSE')).upper() == "TRUE":
+            if curr_user.get('is_verified', False):
                 st.success("✅ 인증 회원입니다")
 
             # 다크 모드 토글
@@ -329,10 +2428,10 @@ def main_app():
             col_refresh, col_clear = st.columns(2)
             with col_refresh:
                 if st.button("🔄 새로고침", use_container_width=True):
-                    st.cache_data.clear(); st.rerun()
+                    get_cache().expire(); st.rerun()
             with col_clear:
                 if st.button("🗑️ 캐시 삭제", use_container_width=True):
-                    st.cache_data.clear(); st.cache_resource.clear(); st.rerun()
+                    st.cache_resource.clear(); st.rerun()
 
             st.divider()
             
@@ -350,11 +2449,9 @@ def main_app():
                     new_contact = st.text_input("연락처", value=curr_user.get('contact', ''))
                     new_pw = st.text_input("새 비번", type="password")
                     if st.form_submit_button("저장", use_container_width=True):
-                        users.loc[users['user_id'] == st.session_state['user_id'], 'company_name'] = new_comp
-                        users.loc[users['user_id'] == st.session_state['user_id'], 'contact'] = new_contact
-                        if new_pw.strip():
-                            users.loc[users['user_id'] == st.session_state['user_id'], 'password_hash'] = hash_password(new_pw)
-                        save_data("users", update_df=users)
+                        patch = {'company_name': new_comp, 'contact': new_contact}
+                        if new_pw.strip(): patch['password_hash'] = hash_password(new_pw)
+                        update_data("users", {st.session_state['user_id']: patch})
                         st.success("수정 완료"); time.sleep(1); st.rerun()
 
             if st.button("로그아웃", use_container_width=True, type="secondary"):
@@ -363,189 +2460,13 @@ def main_app():
 
     st.markdown("<div class='main-header'>🏭 Factory Link <span style='font-size:1.5rem; color:#64748B;'>1.5 (Beta)</span></div>", unsafe_allow_html=True)
     
-    tabs = st.tabs(["🗺️ 지도 검색", "📝 매물 등록", "📂 내 거래 관리", "🔔 수신 메시지함", "⚙️ 관리자"]) if st.session_state.get('is_admin') else st.tabs(["🗺️ 지도 검색", "📝 매물 등록", "📂 내 거래 관리", "🔔 수신 메시지함"])
-    
-    # [Tab 1] 지도 검색
-    with tabs[0]:
-        df = load_data("resources")
-        msgs = load_data("messages")
-        
-        with st.container(border=True):
-            c_search, c_filter = st.columns([2, 1])
-            with c_search: search_kw = st.text_input("🔍 통합 검색", placeholder="품목, 기업, 내용 등")
-            with c_filter: f_role = st.multiselect("거래 구분", ["팝니다", "삽니다", "수거/운송", "기타"])
-            c1, c2 = st.columns(2)
-            with c1: f_region = st.multiselect("📍 지역", list(REGION_DB.keys()))
-            with c2: f_cat = st.multiselect("📦 카테고리", list(CATEGORIES))
-        
-        tile = "CartoDB dark_matter" if st.session_state['dark_mode'] else "OpenStreetMap"
-        m = folium.Map(location=[36.5, 127.8], zoom_start=7, tiles=tile)
-        marker_cluster = MarkerCluster().add_to(m)
-        
-        filtered = df.copy()
-        if not df.empty and 'lat' in df.columns:
-            df['lat'] = pd.to_numeric(df['lat'], errors='coerce'); df['lon'] = pd.to_numeric(df['lon'], errors='coerce')
-            filtered = df.dropna(subset=['lat', 'lon'])
-            if search_kw: filtered = filtered[filtered.astype(str).apply(lambda x: x.str.contains(search_kw)).any(axis=1)]
-            if f_region: filtered = filtered[filtered['region'].isin(f_region)]
-            if f_cat: filtered = filtered[filtered['category'].isin(f_cat)]
-            if f_role: filtered = filtered[filtered['role'].isin(f_role)]
-
-            for _, row in filtered.iterrows():
-                color = 'blue'
-                if row['role'] == "수거/운송": color = 'black'
-                elif "설비" in row['category']: color = 'purple'
-                elif "부산물" in row['category']: color = 'red'
-                folium.Marker([row['lat'], row['lon']], popup=f"<b>{row['item']}</b><br>{row['company']}", icon=folium.Icon(color=color, icon='info-sign')).add_to(marker_cluster)
-        
-        st_folium(m, width=1000, height=400)
-        st.subheader(f"📋 매물 리스트 ({len(filtered)}건)")
-        
-        if filtered.empty: st.info("매물이 없습니다.")
-        else:
-            for idx, row in filtered.iterrows():
-                label = f"[{row['role']}] {row['item']} - {row['company']}"
-                with st.expander(label):
-                    st.markdown(f"#### 🏭 {row['item']}")
-                    c1, c2 = st.columns(2)
-                    with c1: st.write(f"**지역:** {row['region']}"); st.write(f"**카테고리:** {row['category']}")
-                    with c2: 
-                        st.write(f"**등록일:** {row['date']}")
-                        ver = "✅ 인증회원" if str(row['verified'])=="TRUE" else "미인증"
-                        st.write(f"**상태:** {ver}")
-                    st.divider()
-                    if row['process']: st.info(f"**공정:** {row['process']}")
-                    st.write(row['desc'])
-                    st.divider()
-                    
-                    if row['writer_id'] == st.session_state['user_id']:
-                        st.button("내 글", disabled=True, key=f"my_{idx}")
-                    else:
-                        my_req = msgs[(msgs['from_user'] == st.session_state['user_id']) & (msgs['item_id'] == str(row['id']))] if not msgs.empty else pd.DataFrame()
-                        if my_req.empty:
-                            if st.button("💬 연락처 요청 (클릭)", key=f"req_{idx}", type="primary", use_container_width=True):
-                                new_msg = {"req_id": int(time.time()), "from_user": st.session_state['user_id'], "to_user": row['writer_id'], "item_id": str(row['id']), "status": "requested", "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M")}
-                                save_data("messages", new_data_dict=new_msg); st.rerun()
-                        else:
-                            stt = my_req.iloc[0]['status']
-                            if stt == 'approved': st.success("✅ 승인됨! 메시지함 확인")
-                            elif stt == 'rejected': st.error("❌ 거절됨")
-                            else: st.warning("⏳ 승인 대기 중")
-
-    # [Tab 2] 매물 등록
-    with tabs[1]:
-        st.subheader("📝 신규 매물 등록")
-        c1, c2 = st.columns(2)
-        with c1: region = st.selectbox("권역", list(REGION_DB.keys()))
-        with c2: role = st.selectbox("구분", ["팝니다", "삽니다", "수거/운송", "기타"])
-        cat = st.selectbox("카테고리", CATEGORIES)
-        
-        title = st.text_input("제목 (예: 500L 반응기)")
-        proc = st.text_input("공정 스펙 (선택)")
-        desc = st.text_area("상세 내용 (상태, 가격 등)", height=150)
-        st.divider()
-        company = st.text_input("기업명", value=curr_user.get('company_name',''))
-        contact = st.text_input("연락처", value=curr_user.get('contact',''))
-        
-        if st.button("등록 완료", type="primary", use_container_width=True):
-            if not title or not desc: st.error("제목과 내용은 필수입니다.")
-            else:
-                lat = REGION_DB[region][0] + random.uniform(-0.1, 0.1)
-                lon = REGION_DB[region][1] + random.uniform(-0.1, 0.1)
-                is_ver = "TRUE" if (st.session_state.get('is_admin') or str(curr_user.get('is_verified')).upper()=="TRUE") else "FALSE"
-                new_data = {"id": str(int(time.time())), "writer_id": st.session_state['user_id'], "date": datetime.now().strftime("%Y-%m-%d"), "company": company, "contact": contact, "region": region, "role": role, "category": cat, "item": title, "lat": lat, "lon": lon, "desc": desc, "process": proc, "verified": is_ver, "image_path": ""}
-                save_data("resources", new_data_dict=new_data)
-                st.success("등록됨!"); st.balloons(); time.sleep(1); st.rerun()
-
-    # [Tab 3] 내 거래 관리
-    with tabs[2]:
-        st.subheader("📂 내 거래 관리")
-        ts, tb = st.tabs(["📤 판매 내역", "📥 구매/요청 내역"])
-        with ts:
-            res = load_data("resources")
-            my_res = res[res['writer_id'] == st.session_state['user_id']] if not res.empty else pd.DataFrame()
-            if my_res.empty: st.info("등록된 매물이 없습니다.")
-            else:
-                for _, r in my_res.iterrows():
-                    with st.expander(f"[{r['role']}] {r['item']}"):
-                        st.write(r['desc'])
-                        if st.button("🗑️ 삭제", key=f"del_{r['id']}"):
-                            save_data("resources", update_df=res[res['id'] != r['id']]); st.success("삭제됨"); st.rerun()
-        with tb:
-            msgs = load_data("messages")
-            res = load_data("resources")
-            my_req = msgs[msgs['from_user'] == st.session_state['user_id']] if not msgs.empty else pd.DataFrame()
-            if my_req.empty: st.info("요청 내역이 없습니다.")
-            else:
-                for _, req in my_req.iterrows():
-                    tgt = res[res['id'] == str(req['item_id'])]
-                    t_item = tgt.iloc[0] if not tgt.empty else None
-                    if t_item is not None:
-                        stat = req['status']
-                        color = "status-wait" if stat=='requested' else "status-ok" if stat=='approved' else "status-no"
-                        txt = "승인 대기" if stat=='requested' else "승인됨" if stat=='approved' else "거절됨"
-                        cont = f"📞 {t_item['contact']}" if stat=='approved' else "🔒 비공개"
-                        
-                        with st.container(border=True):
-                            c1, c2 = st.columns([3, 1])
-                            c1.markdown(f"**{t_item['item']}** ({t_item['company']})")
-                            c1.markdown(f"👉 {cont}")
-                            c2.markdown(f'<span class="status-badge {color}">{txt}</span>', unsafe_allow_html=True)
-
-    # [Tab 4] 수신함
-    with tabs[3]:
-        st.subheader("🔔 수신 메시지함")
-        msgs = load_data("messages")
-        res = load_data("resources")
-        users = load_data("users")
-        my_in = msgs[msgs['to_user'] == st.session_state['user_id']] if not msgs.empty else pd.DataFrame()
-        
-        if my_in.empty: st.info("받은 요청이 없습니다.")
-        else:
-            for i, row in my_in.iterrows():
-                sender = users[users['user_id'] == row['from_user']].iloc[0] if not users.empty else None
-                item = res[res['id'] == str(row['item_id'])].iloc[0] if not res.empty else None
-                if sender is not None and item is not None:
-                    with st.expander(f"🔔 {sender['company_name']} -> {item['item']}"):
-                        st.caption(f"요청 시간: {row['timestamp']}")
-                        if row['status'] == 'requested':
-                            c1, c2 = st.columns(2)
-                            if c1.button("수락", key=f"y_{i}"):
-                                msgs.loc[i, 'status'] = 'approved'; save_data("messages", update_df=msgs); st.rerun()
-                            if c2.button("거절", key=f"n_{i}"):
-                                msgs.loc[i, 'status'] = 'rejected'; save_data("messages", update_df=msgs); st.rerun()
-                        else: st.write(f"상태: {row['status']}")
-
-    # [Tab 5] 관리자
-    if st.session_state.get('is_admin'):
-        with tabs[4]:
-            st.subheader("⚙️ 관리자")
-            users = load_data("users")
-            res = load_data("resources")
-            
-            st.caption("회원 정보 수정 (is_verified -> TRUE/FALSE)")
-            ed_users = st.data_editor(users, hide_index=True, disabled=["user_id"], column_config={"is_verified": st.column_config.SelectboxColumn("인증", options=["TRUE", "FALSE"], required=True)})
-            if st.button("저장"): save_data("users", update_df=ed_users); st.success("저장됨"); time.sleep(1); st.rerun()
-            
-            st.divider()
-            st.caption("비밀번호 리셋")
-            with st.form("pw_rst"):
-                u = st.selectbox("ID", users['user_id'].unique())
-                p = st.text_input("새 비번", value="1234")
-                if st.form_submit_button("변경"):
-                    users.loc[users['user_id']==u, 'password_hash'] = hash_password(p)
-                    save_data("users", update_df=users); st.success("변경됨")
-            
-            st.divider()
-            st.caption("매물 삭제 (10개씩)")
-            if not res.empty:
-                pg = st.number_input("페이지", 1, math.ceil(len(res)/10), 1)
-                sl = res.iloc[(pg-1)*10 : pg*10].copy()
-                sl.insert(0, "선택", False)
-                ed_res = st.data_editor(sl, hide_index=True)
-                if st.button("삭제"):
-                    dels = ed_res[ed_res['선택']]['id'].tolist()
-                    save_data("resources", update_df=res[~res['id'].isin(dels)]); st.success("삭제됨"); st.rerun()
+    # on_change="rerun": 선택된 탭의 데이터 로드/렌더링만 실행
+    views = [("🗺️ 지도 검색", render_map_tab), ("📝 매물 등록", render_register_tab), ("📂 내 거래 관리", render_deals_tab), ("🔔 수신 메시지함", render_inbox_tab)]
+    if st.session_state.get('is_admin'): views.append(("⚙️ 관리자", render_admin_tab))
+    tabs = st.tabs([name for name, _ in views], key="main_tab", on_change="rerun")
+    for tab, (name, view) in zip(tabs, views):
+        if tab.open:
+            with tab, get_metrics().timed("page", page=name): view(curr_user)
 
     render_legal_notice()
     render_footer()
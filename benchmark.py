@@ -0,0 +1,366 @@
+"""Factory Link 벤치마크: 가짜 구글 시트 + 합성 데이터로 주요 화면을 AppTest로 재현해 측정
+
+    python benchmark.py                       # 1k, 10k 행
+    python benchmark.py --rows 100000 --latency 0.2 --quota-rate 0.02 --json bench.json
+
+행 수는 매물(resources)과 메시지(messages) 기준이고 회원(users)은 그 1/10.
+측정값: 동작(재실행)별 소요 시간, 그 동작이 부른 시트 API 호출 수, 프로세스 최대 RSS(및 --trace-memory 시 동작별 최대 할당량)
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock
+
+import numpy as np
+import requests
+import gspread
+from gspread.utils import a1_to_rowcol
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+try:
+    import resource
+except ImportError: # Windows: RSS 측정 생략
+    resource = None
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+BENCH_USER, BENCH_PW = "u0", "bench"
+INBOX_REQUESTS = 20 # 측정용 사용자가 받은 대기 중 요청 수
+
+def app_constants():
+    # app.py를 실행하지 않고 컬럼/코드 목록만 읽어옴 (스키마가 바뀌어도 벤치마크는 그대로)
+    wanted = {"COLS_RESOURCES", "COLS_USERS", "COLS_MESSAGES", "REGION_DB", "CATEGORIES", "ROLES", "META_SHEET", "WRITE_FLUSH_SEC"}
+    found = {}
+    with open(APP, encoding="utf-8") as f: tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in wanted: found[name] = ast.literal_eval(node.value)
+            elif name == "SHEET_COLS": found[name] = [k.value for k in node.value.keys]
+    return found
+
+C = app_constants()
+
+# === 가짜 gspread (app.py가 쓰는 Spreadsheet / Worksheet 메서드만) ===
+class FakeAPI:
+    # 호출 집계 + 호출마다 지연 + 일정 확률로 429(요청 한도 초과)
+    def __init__(self, latency=0.0, quota_rate=0.0, seed=0):
+        self.latency, self.quota_rate = latency, quota_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def __call__(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            throttled = self.rng.random() < self.quota_rate
+        if self.latency: time.sleep(self.latency)
+        if throttled: raise api_error(429, "Quota exceeded for quota metric 'Read requests'", retry_after="1")
+
+    def total(self):
+        with self.lock: return sum(self.calls.values())
+
+def api_error(code, message, retry_after=None):
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({"error": {"code": code, "message": message, "status": "ERROR"}}).encode()
+    if retry_after: response.headers["Retry-After"] = retry_after
+    return gspread.exceptions.APIError(response)
+
+def _split_range(rng):
+    m = re.match(r"^'?(.*?)'?!(.*)$", rng)
+    return (m.group(1), m.group(2)) if m else (rng.strip("'"), "")
+
+def _bounds(a1):
+    # "A2:C4" / "1:1" / "A:A" / "" -> (행1, 열1, 행2 또는 None, 열2 또는 None)
+    if not a1: return 1, 1, None, None
+    def one(part):
+        col, row = re.match(r"^([A-Z]*)(\d*)$", part).groups()
+        c = None
+        if col:
+            c = 0
+            for ch in col: c = c * 26 + ord(ch) - 64
+        return (int(row) if row else None), c
+    parts = a1.split(":")
+    r1, c1 = one(parts[0])
+    r2, c2 = one(parts[-1]) if len(parts) > 1 else (r1, c1)
+    return r1 or 1, c1 or 1, r2, c2
+
+class FakeWorksheet:
+    def __init__(self, api, title, sheet_id, rows=None):
+        self.api, self.title, self.id = api, title, sheet_id
+        self.rows = rows or []
+
+    def _set(self, r, c, value):
+        while len(self.rows) < r: self.rows.append([])
+        row = self.rows[r - 1]
+        while len(row) < c: row.append("")
+        row[c - 1] = str(value)
+
+    def _write(self, values, a1):
+        r0, c0 = a1_to_rowcol(a1.split(":")[0])
+        for i, row in enumerate(values):
+            for j, v in enumerate(row): self._set(r0 + i, c0 + j, v)
+
+    def _slice(self, a1):
+        r1, c1, r2, c2 = _bounds(a1)
+        out = [list(r[c1 - 1:(c2 or len(r))]) for r in self.rows[r1 - 1:(r2 or len(self.rows))]]
+        while out and not any(out[-1]): out.pop()
+        return out
+
+    def row_values(self, r):
+        self.api("row_values"); return list(self.rows[r - 1]) if len(self.rows) >= r else []
+
+    def col_values(self, c):
+        self.api("col_values"); return [row[c - 1] if len(row) >= c else "" for row in self.rows]
+
+    def get_all_values(self):
+        self.api("get_all_values"); return [list(r) for r in self.rows]
+
+    def update(self, values, range_name="A1", **kwargs):
+        self.api("update"); self._write(values, range_name)
+
+    def batch_update(self, data, **kwargs):
+        self.api("batch_update")
+        for d in data: self._write(d["values"], d["range"])
+
+    def append_rows(self, values, **kwargs):
+        self.api("append_rows"); self.rows.extend([[str(v) for v in r] for r in values])
+
+    def clear(self):
+        self.api("clear"); self.rows = []
+
+class FakeSpreadsheet:
+    def __init__(self, api, tables):
+        self.api = api
+        self.sheets = {name: FakeWorksheet(api, name, i + 1, rows) for i, (name, rows) in enumerate(tables.items())}
+
+    def _sheet(self, rng):
+        name, a1 = _split_range(rng)
+        if name not in self.sheets: raise api_error(400, f"Unable to parse range: {rng}")
+        return self.sheets[name], a1
+
+    def worksheet(self, name):
+        self.api("worksheet")
+        if name not in self.sheets: raise gspread.exceptions.WorksheetNotFound(name)
+        return self.sheets[name]
+
+    def worksheets(self):
+        self.api("worksheets"); return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows=100, cols=26):
+        self.api("add_worksheet")
+        if title in self.sheets: raise api_error(400, f'Invalid requests[0].addSheet: A sheet with the name "{title}" already exists. Please enter another name.')
+        self.sheets[title] = FakeWorksheet(self.api, title, len(self.sheets) + 1)
+        return self.sheets[title]
+
+    def values_get(self, rng, params=None):
+        self.api("values_get")
+        ws, a1 = self._sheet(rng)
+        return {"range": rng, "values": ws._slice(a1)}
+
+    def values_batch_get(self, ranges, params=None):
+        self.api("values_batch_get")
+        out = []
+        for rng in ranges:
+            ws, a1 = self._sheet(rng)
+            out.append({"range": rng, "values": ws._slice(a1)})
+        return {"valueRanges": out}
+
+    def values_update(self, rng, params=None, body=None):
+        self.api("values_update")
+        ws, a1 = self._sheet(rng)
+        ws._write(body["values"], a1 or "A1")
+
+    def batch_update(self, body):
+        self.api("spreadsheet_batch_update")
+        for req in body.get("requests", []):
+            span = req["deleteDimension"]["range"]
+            ws = next(w for w in self.sheets.values() if w.id == span["sheetId"])
+            del ws.rows[span["startIndex"]:span["endIndex"]]
+
+# === 합성 데이터 ===
+ITEMS = ["반응기", "열교환기", "펌프", "컨베이어", "보일러", "냉각탑", "폐유", "슬러지", "폐촉매", "파렛트", "드럼통", "스크랩", "지게차", "집진기", "압축기"]
+
+def _table(cols, values, n):
+    # values: {컬럼: 길이 n 목록} -> [머리글] + 행 목록 (없는 컬럼은 빈 칸)
+    blank = [""] * n
+    return [list(cols)] + [list(r) for r in zip(*(values.get(c, blank) for c in cols))]
+
+def generate(n, seed=0):
+    # -> {시트: 행 목록}. 매물/메시지 n행, 회원 n/10행 (측정용 사용자 u0 포함)
+    rng = np.random.default_rng(seed)
+    n_users = max(n // 10, 10)
+    users = [f"u{i}" for i in range(n_users)]
+    pw = hashlib.sha256(BENCH_PW.encode()).hexdigest()
+    days = np.datetime64("2025-01-01") + rng.integers(0, 640, n)
+    regions, centers = list(C["REGION_DB"]), np.array(list(C["REGION_DB"].values()))
+    region_idx = rng.integers(0, len(regions), n)
+    items = np.array(ITEMS)[rng.integers(0, len(ITEMS), n)]
+    writers = np.array(users)[rng.integers(0, n_users, n)]
+    writers[:INBOX_REQUESTS] = BENCH_USER
+    resources = {
+        "id": [str(1_600_000_000 + i) for i in range(n)],
+        "writer_id": writers.tolist(),
+        "date": days.astype(str).tolist(),
+        "company": [f"기업{w[1:]}" for w in writers],
+        "contact": [f"010-{i % 10000:04d}-{i * 7 % 10000:04d}" for i in range(n)],
+        "region": [regions[i] for i in region_idx],
+        "role": np.array(C["ROLES"])[rng.integers(0, len(C["ROLES"]), n)].tolist(),
+        "category": np.array(C["CATEGORIES"])[rng.integers(0, len(C["CATEGORIES"]), n)].tolist(),
+        "item": [f"{it} {s}L" for it, s in zip(items, rng.integers(10, 5000, n))],
+        "lat": np.round(centers[region_idx, 0] + rng.uniform(-0.3, 0.3, n), 6).astype(str).tolist(),
+        "lon": np.round(centers[region_idx, 1] + rng.uniform(-0.3, 0.3, n), 6).astype(str).tolist(),
+        "desc": [f"{it} 상태 양호, 사용 {y}년" for it, y in zip(items, rng.integers(1, 15, n))],
+        "verified": np.where(rng.random(n) < 0.3, "TRUE", "FALSE").tolist(),
+        "updated_at": ["1"] * n,
+    }
+    user_rows = {
+        "user_id": users,
+        "password_hash": [pw] * n_users,
+        "company_name": [f"기업{i}" for i in range(n_users)],
+        "contact": [f"010-0000-{i % 10000:04d}" for i in range(n_users)],
+        "biz_no": ["-"] * n_users,
+        "is_verified": np.where(rng.random(n_users) < 0.3, "TRUE", "FALSE").tolist(),
+        "deal_count": rng.integers(0, 50, n_users).astype(str).tolist(),
+        "reputation": np.round(rng.uniform(0, 100, n_users), 1).astype(str).tolist(),
+        "join_date": (np.datetime64("2024-01-01") + rng.integers(0, 900, n_users)).astype(str).tolist(),
+        "updated_at": ["1"] * n_users,
+    }
+    # 앞 INBOX_REQUESTS건은 u0의 매물에 대한 대기 중 요청 (수락 시나리오용)
+    item_idx = rng.integers(0, n, n)
+    item_idx[:INBOX_REQUESTS] = np.arange(INBOX_REQUESTS)
+    senders = np.array(users[1:])[rng.integers(0, n_users - 1, n)]
+    messages = {
+        "req_id": [str(1_700_000_000 + i) for i in range(n)],
+        "from_user": senders.tolist(),
+        "to_user": writers[item_idx].tolist(),
+        "item_id": [resources["id"][i] for i in item_idx],
+        "status": np.where(np.arange(n) < INBOX_REQUESTS, "requested", np.array(["requested", "approved", "rejected"])[rng.integers(0, 3, n)]).tolist(),
+        "timestamp": [f"{d} {h:02d}:{m:02d}" for d, h, m in zip((np.datetime64("2025-01-01") + rng.integers(0, 640, n)).astype(str), rng.integers(0, 24, n), rng.integers(0, 60, n))],
+        "updated_at": ["1"] * n,
+    }
+    tables = {"resources": _table(C["COLS_RESOURCES"], resources, n), "users": _table(C["COLS_USERS"], user_rows, n_users), "messages": _table(C["COLS_MESSAGES"], messages, n)}
+    tables[C["META_SHEET"]] = [["sheet", "rev", "epoch"]] + [[name, "1", "1"] for name in C["SHEET_COLS"]]
+    return tables
+
+# === 시나리오 ===
+class Bench:
+    def __init__(self, api, settle, trace_memory=False):
+        self.api, self.settle, self.trace_memory = api, settle, trace_memory
+        self.results = []
+
+    def app(self, user=None, tab=None):
+        at = AppTest.from_file(APP, default_timeout=600)
+        at.secrets["gcp_service_account"] = {"type": "service_account"}
+        if user:
+            at.session_state["logged_in"], at.session_state["user_id"], at.session_state["is_admin"] = True, user, False
+        if tab: at.session_state["main_tab"] = tab
+        return at
+
+    def measure(self, scenario, action):
+        # action() 한 번의 소요 시간과, 백그라운드 쓰기/갱신이 끝날 때까지 포함한 API 호출 수
+        before = self.api.total()
+        if self.trace_memory: tracemalloc.reset_peak()
+        start = time.perf_counter()
+        at = action()
+        elapsed = time.perf_counter() - start
+        time.sleep(self.settle)
+        errors = [e.value for e in at.exception] if at is not None else []
+        self.results.append({"scenario": scenario, "ms": elapsed * 1000, "api_calls": self.api.total() - before,
+                             "peak_alloc_mb": tracemalloc.get_traced_memory()[1] / 2 ** 20 if self.trace_memory else None,
+                             "rss_mb": rss_mb(), "errors": errors})
+        return at
+
+    def run(self, repeat):
+        def cold_login():
+            st.cache_resource.clear()
+            at = self.app().run()
+            at.text_input[0].input(BENCH_USER); at.text_input[1].input(BENCH_PW)
+            return at.button[0].click().run()
+        def map_tab():
+            return self.app(BENCH_USER).run()
+        def map_search():
+            at = self.app(BENCH_USER).run()
+            return next(t for t in at.text_input if t.label.startswith("🔍")).input(random.choice(ITEMS)).run()
+        def map_rerun():
+            return self.app(BENCH_USER).run().run()
+        def register():
+            at = self.app(BENCH_USER, "📝 매물 등록").run()
+            inputs = {t.label: t for t in at.text_input}
+            inputs["제목 (예: 500L 반응기)"].input("벤치마크 반응기"); at.text_area[0].input("측정용 매물")
+            return next(b for b in at.button if b.label == "등록 완료").click().run()
+        def inbox_accept():
+            at = self.app(BENCH_USER, "🔔 수신 메시지함").run()
+            accept = [b for b in at.button if b.label == "수락"]
+            return accept[0].click().run() if accept else at
+        self.measure("cold_login", cold_login)
+        for _ in range(repeat):
+            for name, action in [("map_tab", map_tab), ("map_search", map_search), ("map_rerun", map_rerun), ("register", register), ("inbox_accept", inbox_accept)]:
+                self.measure(name, action)
+        return self.results
+
+def rss_mb():
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10 # macOS는 바이트, 리눅스는 KB
+
+def summarize(rows, results):
+    out = []
+    for scenario in dict.fromkeys(r["scenario"] for r in results):
+        runs = [r for r in results if r["scenario"] == scenario]
+        out.append({"rows": rows, "scenario": scenario, "runs": len(runs),
+                    "median_ms": statistics.median(r["ms"] for r in runs), "max_ms": max(r["ms"] for r in runs),
+                    "api_calls": statistics.median(r["api_calls"] for r in runs),
+                    "peak_alloc_mb": max((r["peak_alloc_mb"] or 0) for r in runs) if runs[0]["peak_alloc_mb"] is not None else None,
+                    "rss_mb": max((r["rss_mb"] or 0) for r in runs), "errors": sorted({e for r in runs for e in r["errors"]})})
+    return out
+
+def bench(rows, args):
+    api = FakeAPI(args.latency, args.quota_rate, args.seed)
+    spreadsheet = FakeSpreadsheet(api, generate(rows, args.seed))
+    settle = C["WRITE_FLUSH_SEC"] + 0.2 + args.latency * 4
+    with tempfile.TemporaryDirectory() as snapshots, \
+         mock.patch.dict(os.environ, {"FACTORY_LINK_STORAGE": "gsheets", "FACTORY_LINK_SNAPSHOTS": snapshots, "FACTORY_LINK_SHARED": ""}), \
+         mock.patch("gspread.authorize") as authorize, \
+         mock.patch("oauth2client.service_account.ServiceAccountCredentials.from_json_keyfile_dict"):
+        authorize.return_value.open.return_value = spreadsheet
+        results = Bench(api, settle, args.trace_memory).run(args.repeat)
+        st.cache_resource.clear() # 백그라운드 쓰기 스레드 정리
+    return summarize(rows, results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Factory Link 벤치마크 (가짜 시트 백엔드)")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000], help="매물/메시지 행 수 (여러 개 가능)")
+    parser.add_argument("--latency", type=float, default=0.05, help="API 호출당 지연 (초)")
+    parser.add_argument("--quota-rate", type=float, default=0.0, help="API 호출이 429로 실패할 확률")
+    parser.add_argument("--repeat", type=int, default=3, help="시나리오 반복 횟수")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="동작별 최대 할당량 측정 (tracemalloc, 느려짐)")
+    parser.add_argument("--json", help="결과를 JSON으로 저장할 경로")
+    args = parser.parse_args()
+
+    if args.trace_memory: tracemalloc.start()
+    summary = []
+    for rows in args.rows:
+        print(f"== {rows:,}행 (지연 {args.latency * 1000:.0f}ms, 429 확률 {args.quota_rate:.0%}) ==", flush=True)
+        for r in bench(rows, args):
+            summary.append(r)
+            alloc = f"  alloc {r['peak_alloc_mb']:7.1f}MB" if r['peak_alloc_mb'] is not None else ""
+            rss = f"  rss {r['rss_mb']:7.1f}MB" if r['rss_mb'] is not None else ""
+            print(f"{r['scenario']:<13} median {r['median_ms']:8.1f}ms  max {r['max_ms']:8.1f}ms  api {r['api_calls']:5.1f}{alloc}{rss}" + (f"  오류 {r['errors']}" if r['errors'] else ""), flush=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"latency": args.latency, "quota_rate": args.quota_rate, "repeat": args.repeat, "results": summary}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()